@@ -21,26 +21,48 @@
 
 ### Imports ###
 
+# Annotations are never evaluated, so GitPython's types can be named without importing it
+from __future__ import annotations
+
 # Version guard
 import sys
 if sys.version_info < (3, 10):
     print("Python 3.10 or later is required.")
     sys.exit(1)
 
+import contextvars
+import fnmatch
+import json
 import os
-from git import Repo
-from git.exc import InvalidGitRepositoryError
+import queue
+import stat
+import struct
+import subprocess
+import threading
+import time
+import urllib.parse
+import zlib
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
 import argparse
-from typing import Dict, Union, Set, Tuple, NewType, NamedTuple
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from typing import IO, TYPE_CHECKING, AsyncIterator, Callable, Dict, Iterable, Iterator, TextIO, Union, Set, Tuple, NewType, NamedTuple
 from dataclasses import dataclass
 import logging
 
 logger = logging.getLogger(__name__)
 
-from colorama import init as colorama_init
-from colorama import Fore, Style
-
-colorama_init()
+# Startup is kept light because the checker runs from shell prompts and cron. The heavy modules are imported where they're needed:
+# GitPython (most of the import time) by the GitPython backend, asyncio by --async, colorama by setup_colors() for --color,
+# the process pool, cProfile and tempfile by --processes, --profile and --fetch, and socketserver by --serve.
+if TYPE_CHECKING:
+    import asyncio
+    import socketserver
+    from git import Head, Reference, Repo
 
 ##############################################################################
 
@@ -50,9 +72,67 @@ colorama_init()
 
 #### Typedefs ####
 
+class PathList:
+    """An immutable list of paths, stored as a single NUL separated string.
+    Every str object costs ~50 bytes on top of its characters, which adds up to most of the memory of scans listing millions of files.
+    Paths can't contain NUL, so it's a safe separator. The paths are only split apart again when iterated."""
+    __slots__ = ("joined", "count")
+
+    def __init__(self, paths: Iterable[str] = ()):
+        if isinstance(paths, PathList):
+            self.joined, self.count = paths.joined, paths.count
+            return
+        paths = paths if isinstance(paths, (list, tuple)) else list(paths)
+        self.joined = "\0".join(paths)
+        self.count = len(paths)
+
+    def __iter__(self) -> Iterator[str]:
+        # Splitting "" would give a single empty path
+        return iter(self.joined.split("\0") if self.count else ())
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, PathList):
+            return self.count == other.count and self.joined == other.joined
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash((self.count, self.joined))
+
+    def __repr__(self) -> str:
+        return f"PathList({list(self)!r})"
+
+    def __getstate__(self) -> Tuple[str, int]:
+        return self.joined, self.count
+
+    def __setstate__(self, state: Tuple[str, int]):
+        self.joined, self.count = state
+
 class RepoFiles(NamedTuple):
-    modified: list[str] = []
-    untracked: list[str] = []
+    modified: PathList = PathList()
+    untracked: PathList = PathList()
+    # Totals, the lists above may be capped. Both are 0 when files aren't listed, they aren't gathered at all then (see inspect_repo_quick)
+    modified_count: int = 0
+    untracked_count: int = 0
+
+class CheckOptions(NamedTuple):
+    list_files: bool = True # Gather the file lists, otherwise only decide whether the repository is stale
+    untracked: str = "normal" # One of UNTRACKED_MODES, the same default as --untracked
+    max_files: Union[int, None] = None # Cap on each listed file list
+    all_branches: bool = False # Audit every local branch, not just the active one
+    timings: bool = False # Record how long each phase of the check took
+    cpu_times: bool = False # Also split each check into Python and git CPU time, only meaningful when checks run one at a time
+
+class BranchStatus(NamedTuple):
+    name: str
+    upstream: str = ""
+    ahead: int = 0
+    behind: int = 0
+    state: str = "ok" # One of the REPO_STATE_* constants
 
 # StaleResult = Tuple[str, bool, list[str]]
 class StaleResult(NamedTuple):
@@ -60,21 +140,213 @@ class StaleResult(NamedTuple):
     stale: bool
     status_message: str = ""
     files: RepoFiles = RepoFiles()
+    ahead: int = 0
+    behind: int = 0
+    state: str = "ok" # One of the REPO_STATE_* constants
+    branches: Tuple[BranchStatus, ...] = () # Out of sync branches, only audited with --all-branches
+    timings: Union[Dict[str, float], None] = None # Seconds spent per phase (and in total), only recorded with --timings
+
+class PorcelainStatus(NamedTuple):
+    branch: str = ""
+    upstream: str = ""
+    ahead: int = 0
+    behind: int = 0
+    changed: bool = False
+    files: RepoFiles = RepoFiles()
+    state: str = "ok"
+
+
+class IndexEntry(NamedTuple):
+    path: str
+    mode: int
+    mtime_s: int
+    mtime_ns: int
+    size: int
+
+class GitIndex(NamedTuple):
+    entries: list[IndexEntry]
+    tree: Union[str, None] = None # Cache tree root, None if invalidated
+
+@dataclass
+class ScanStats:
+    candidates: int = 0
+    skipped: int = 0 # Candidates that weren't repositories
+    cached: int = 0 # Repositories whose cached result was reused
+    fetched: int = 0
+    fetch_failed: int = 0
+
+class FetchResult(NamedTuple):
+    directory: str
+    ok: bool
+    message: str = ""
+    duration: float = 0.0 # Seconds
 
 
 #### Constants ####
 
-COLOR_REPO      = Fore.GREEN
-COLOR_STATUS    = Fore.LIGHTCYAN_EX
-COLOR_FILE      = Fore.LIGHTWHITE_EX
-COLOR_UNTRACKED = Fore.LIGHTYELLOW_EX
-COLOR_MODIFIED  = Fore.LIGHTRED_EX
+# Colors for --color, empty until setup_colors() imports colorama and fills them in
+COLOR_REPO = COLOR_STATUS = COLOR_FILE = COLOR_UNTRACKED = COLOR_MODIFIED = COLOR_BRANCH = COLOR_AHEAD = COLOR_BEHIND = ""
+STYLE_REPO = STYLE_STATUS = STYLE_FILE = STYLE_UNTRACKED = STYLE_MODIFIED = STYLE_BRANCH = ""
+
+# How a repository's branch relates to its upstream, reported in StaleResult.state
+REPO_STATE_OK            = "ok"
+REPO_STATE_NO_UPSTREAM   = "no-upstream"   # The branch doesn't track anything
+REPO_STATE_UPSTREAM_GONE = "upstream-gone" # The tracked branch doesn't exist (deleted on the remote, or never fetched)
+REPO_STATE_DETACHED      = "detached"      # HEAD isn't on a branch
+REPO_STATE_UNBORN        = "unborn"        # The branch has no commits yet
+REPO_STATE_BARE          = "bare"          # No worktree, never stale
+REPO_STATE_REBASING      = "rebasing"
+REPO_STATE_MERGING       = "merging"
+REPO_STATE_CHERRY_PICKING = "cherry-picking"
+REPO_STATE_REVERTING     = "reverting"
+REPO_STATE_ERROR         = "error"         # The check failed, reported as not stale and never cached
+
+# Files in the git directory that mark an unfinished operation. Any of them makes a repository stale.
+REPO_OPERATION_MARKERS = [
+    ("rebase-merge", REPO_STATE_REBASING),
+    ("rebase-apply", REPO_STATE_REBASING),
+    ("MERGE_HEAD", REPO_STATE_MERGING),
+    ("CHERRY_PICK_HEAD", REPO_STATE_CHERRY_PICKING),
+    ("REVERT_HEAD", REPO_STATE_REVERTING),
+]
+REPO_OPERATION_MESSAGES = {
+    REPO_STATE_REBASING: "A rebase is in progress.",
+    REPO_STATE_MERGING: "A merge is in progress.",
+    REPO_STATE_CHERRY_PICKING: "A cherry-pick is in progress.",
+    REPO_STATE_REVERTING: "A revert is in progress.",
+}
+
+# Repository layouts recognised by classify_repository()
+REPO_LAYOUT_WORKTREE = "worktree" # .git directory
+REPO_LAYOUT_GITFILE  = "gitfile"  # .git file pointing elsewhere (worktrees, submodules)
+REPO_LAYOUT_BARE     = "bare"
+
+# Entries every bare repository has
+BARE_REPO_ENTRIES = {"HEAD", "objects", "refs"}
+
+# Directories never worth descending into when looking for repositories. Extend with --ignore.
+DEFAULT_IGNORE = ["node_modules"]
+
+# `git status` invocation used by the porcelain backend. -z keeps paths unquoted and lets us split on NUL.
+PORCELAIN_STATUS_ARGS = ["status", "--porcelain=v2", "--branch", "-z"]
+
+# How untracked files are reported, same as `git status --untracked-files`. normal collapses untracked directories into a single entry.
+UNTRACKED_MODES = ["no", "normal", "all"]
+
+# Lists every local branch with its upstream and git's own ahead/behind count, so auditing all branches is a single process
+BRANCH_AUDIT_ARGS = ["for-each-ref", "--format=%(refname)%00%(upstream:short)%00%(upstream:track,nobracket)", "refs/heads"]
+
+# Seconds an SSH master connection is kept open after the last fetch using it
+FETCH_CONTROL_PERSIST = 15
+
+# Bytes read at a time when streaming git output
+READ_CHUNK_SIZE = 65536
+
+# Index entry flags, see Documentation/gitformat-index.txt
+INDEX_FLAG_ASSUME_VALID   = 0x8000
+INDEX_FLAG_EXTENDED       = 0x4000
+INDEX_FLAG_STAGE          = 0x3000
+INDEX_FLAG_SKIP_WORKTREE  = 0x4000 # Extended flags
+INDEX_FLAG_INTENT_TO_ADD  = 0x2000 # Extended flags
+GITLINK_MODE              = 0o160000
+
+# Pack object types that aren't deltas
+PACK_OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+
+# Phases of a check recorded with --timings, in report order.
+# python and git are CPU times recorded with --profile, they overlap the phases before them.
+TIMING_PHASES = ["fetch", "cache", "state", "open", "native", "status", "modified", "untracked", "refs", "audit", "python", "git"]
+
+# Number of repositories listed by the --timings report unless given
+DEFAULT_TIMINGS_COUNT = 10
+
+# Seconds between the stack samples taken for --profile's collapsed stacks
+PROFILE_SAMPLE_INTERVAL = 0.001
+
+# inotify event flags, see inotify(7)
+INOTIFY_MODIFY      = 0x00000002
+INOTIFY_ATTRIB      = 0x00000004
+INOTIFY_MOVED_FROM  = 0x00000040
+INOTIFY_MOVED_TO    = 0x00000080
+INOTIFY_CREATE      = 0x00000100
+INOTIFY_DELETE      = 0x00000200
+INOTIFY_Q_OVERFLOW  = 0x00004000
+INOTIFY_IGNORED     = 0x00008000 # The watch was removed, e.g. its directory was deleted
+INOTIFY_ISDIR       = 0x40000000
+INOTIFY_WATCH_MASK  = INOTIFY_MODIFY | INOTIFY_ATTRIB | INOTIFY_MOVED_FROM | INOTIFY_MOVED_TO | INOTIFY_CREATE | INOTIFY_DELETE
+INOTIFY_EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+
+# Seconds --watch waits for more file events before rechecking, so a checkout or a build is one recheck instead of hundreds
+WATCH_DEBOUNCE = 0.2
+
+# Seconds between polls of repositories that can't be watched with inotify, unless given with --poll-interval
+WATCH_POLL_INTERVAL = 2.0
+
+# Longest query line the --serve socket accepts
+QUERY_MAX_REQUEST = 65536
+
+
+#### Timings ####
+
+# Phase timings of the repository being checked by this thread/task. None unless timings were asked for.
+# A context variable, so concurrent checks (threads and asyncio tasks alike) each record into their own.
+current_timings: contextvars.ContextVar[Union[Dict[str, float], None]] = contextvars.ContextVar("current_timings", default=None)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    """Add the wall time spent in the block (or decorated function) to a phase of the repository being checked. Free when timings aren't recorded."""
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def get_children_cpu_time() -> float:
+    """Get the CPU time used by every finished child process so far. (git, for the most part)"""
+    # getrusage has microsecond resolution, os.times only counts clock ticks
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+@contextmanager
+def record_timings(enabled: bool, cpu_times: bool = False) -> Iterator[Dict[str, float]]:
+    """Record the phases timed in the block into the yielded dict, along with the total. Stays empty unless enabled.
+    With cpu_times the CPU time of this thread (python) and of the child processes it waited for (git) are recorded too.
+    Child process times are per process, so they're only right when nothing else runs git at the same time."""
+    timings: Dict[str, float] = {}
+    if not enabled:
+        yield timings
+        return
+
+    token = current_timings.set(timings)
+    start = time.perf_counter()
+    thread_start, children_start = time.thread_time(), get_children_cpu_time()
+    try:
+        yield timings
+    finally:
+        timings["total"] = time.perf_counter() - start
+        if cpu_times:
+            timings["python"] = time.thread_time() - thread_start
+            timings["git"] = get_children_cpu_time() - children_start
+        current_timings.reset(token)
+
 
-STYLE_REPO      = Style.BRIGHT
-STYLE_STATUS    = Style.BRIGHT
-STYLE_FILE      = Style.DIM
-STYLE_UNTRACKED = Style.DIM
-STYLE_MODIFIED  = Style.DIM
+def add_timing(result: StaleResult, phase: str, seconds: float) -> StaleResult:
+    """Add time spent on a repository outside of its check (cache lookups, fetching) to its timings."""
+    timings = dict(result.timings or {})
+    timings[phase] = timings.get(phase, 0.0) + seconds
+    timings["total"] = timings.get("total", 0.0) + seconds
+    return result._replace(timings=timings)
 
 
 #### Methods ####
@@ -96,163 +368,1977 @@ def setup_logging(verbosity: int) -> None:
 
     log_level = logging.ERROR - (10 * min(3, verbosity)) # This is silly
 
+    setup_worker_logging(log_level)
+
+
+def setup_worker_logging(log_level: int) -> None:
+    """Setup logging at an already computed level. Also run in --processes workers, which start fresh instead of inheriting the parent's setup."""
     logging.basicConfig(level=logging.ERROR, format="%(levelname)s: %(message)s")
     logger.setLevel(log_level)
 
 
-def get_repo_commit_diff(repo: Repo) -> int:
-    """Returns the number of commits ahead or behind the active branch's remote. Positive if ahead, negative if behind."""
+def setup_colors() -> None:
+    """Import and initialize colorama, and set the colors used for --color. Nothing is colored otherwise, so this is skipped."""
+    global Fore, Style
+    global COLOR_REPO, COLOR_STATUS, COLOR_FILE, COLOR_UNTRACKED, COLOR_MODIFIED, COLOR_BRANCH, COLOR_AHEAD, COLOR_BEHIND
+    global STYLE_REPO, STYLE_STATUS, STYLE_FILE, STYLE_UNTRACKED, STYLE_MODIFIED, STYLE_BRANCH
+    from colorama import init as colorama_init
+    from colorama import Fore, Style
+
+    colorama_init()
+
+    COLOR_REPO      = Fore.GREEN
+    COLOR_STATUS    = Fore.LIGHTCYAN_EX
+    COLOR_FILE      = Fore.LIGHTWHITE_EX
+    COLOR_UNTRACKED = Fore.LIGHTYELLOW_EX
+    COLOR_MODIFIED  = Fore.LIGHTRED_EX
+    COLOR_BRANCH    = Fore.LIGHTMAGENTA_EX
+    COLOR_AHEAD     = Fore.LIGHTGREEN_EX
+    COLOR_BEHIND    = Fore.LIGHTRED_EX
+
+    STYLE_REPO      = Style.BRIGHT
+    STYLE_STATUS    = Style.BRIGHT
+    STYLE_FILE      = Style.DIM
+    STYLE_UNTRACKED = Style.DIM
+    STYLE_MODIFIED  = Style.DIM
+    STYLE_BRANCH    = Style.NORMAL
+
+
+@timed("refs")
+def count_ahead_behind(repo: Repo, local_ref: str, remote_ref: str) -> Tuple[int, int]:
+    """Count the commits only reachable from local_ref (ahead) and only reachable from remote_ref (behind)."""
+    # The symmetric difference stops at the merge base, so this costs O(divergence) instead of walking the whole history of both branches
+    output = repo.git.rev_list("--left-right", "--count", f"{local_ref}...{remote_ref}")
+    ahead, behind = output.split()
+    return int(ahead), int(behind)
+
+
+@timed("refs")
+def get_tracking_branches(repo: Repo) -> Tuple[Union[Head, None], Union[Reference, None], str]:
+    """Get the active branch (None if detached), the configured upstream it is compared against and the tracking state. The upstream is None unless the state is REPO_STATE_OK."""
+    # Both only read HEAD and the ref it points at, unlike catching what active_branch/commit raise
+    if repo.head.is_detached:
+        return None, None, REPO_STATE_DETACHED
     local_branch = repo.active_branch
-    if len(repo.remotes) == 0:
-        return 0
-    remote = repo.remote()
-    remote_branch = remote.refs[local_branch.name]
-    return local_branch.commit.count() - remote_branch.commit.count()
-
-
-def get_repo_status(repo: Repo) -> str:
-    """Get the status message of a git repository. (How many commits ahead/behind, etc.)"""
-    # status = repo.git.status()
-    status = ""
-
-    diff = get_repo_commit_diff(repo)
-    if diff != 0:
-        adverb = "ahead" if diff > 0 else "behind"
-        local_branch = repo.active_branch
-        if len(repo.remotes) == 0:
-            return 0
-        remote = repo.remote()
-        remote_branch = remote.refs[repo.active_branch.name]
-        status += f"'{local_branch.name}' is {adverb} '{remote_branch.name}' by {abs(diff)} commits."
-    
-    return status
-
-
+    if not local_branch.is_valid():
+        return local_branch, None, REPO_STATE_UNBORN
+
+    upstream = get_upstream_ref(get_git_config(repo.common_dir), local_branch.name)
+    if upstream is None:
+        return local_branch, None, REPO_STATE_NO_UPSTREAM
+
+    from git import Reference
+    remote_branch = Reference(repo, upstream)
+    if not remote_branch.is_valid():
+        return local_branch, None, REPO_STATE_UPSTREAM_GONE
+    return local_branch, remote_branch, REPO_STATE_OK
+
+
+def get_head_name(repo: Repo, local_branch: Union[Head, None]) -> str:
+    """Get the name of what HEAD is on for messages. The abbreviated commit when detached."""
+    if local_branch is not None:
+        return local_branch.name
+    return repo.head.commit.hexsha[:7]
+
+
+def format_tracking_state(local_name: str, state: str) -> str:
+    """Format a message for a branch that can't be compared with its upstream. (local_name is the abbreviated commit when detached)"""
+    if state == REPO_STATE_DETACHED:
+        return f"HEAD is detached at '{local_name}'."
+    if state == REPO_STATE_UNBORN:
+        return f"'{local_name}' has no commits yet."
+    if state == REPO_STATE_NO_UPSTREAM:
+        return f"'{local_name}' has no upstream branch."
+    if state == REPO_STATE_UPSTREAM_GONE:
+        return f"The upstream branch of '{local_name}' is gone."
+    return ""
+
+
+def format_ahead_behind(local_name: str, remote_name: str, ahead: int, behind: int) -> str:
+    """Format a message describing how far apart a local branch and its remote are."""
+    if ahead and behind:
+        return f"'{local_name}' has diverged from '{remote_name}' ({ahead} commits ahead, {behind} commits behind)."
+    if ahead:
+        return f"'{local_name}' is ahead '{remote_name}' by {ahead} commits."
+    if behind:
+        return f"'{local_name}' is behind '{remote_name}' by {behind} commits."
+    return ""
+
+
+def collect_files(files: Iterable[str], options: CheckOptions) -> Tuple[PathList, int]:
+    """Count the files, only keeping as many as will be listed. Returns the kept files and the total."""
+    if not options.list_files:
+        return PathList(), 0 # Same as the GitPython backend, which doesn't look at the files
+
+    kept: list[str] = []
+    count = 0
+    for name in files:
+        if options.max_files is None or count < options.max_files:
+            kept.append(name)
+        count += 1
+    return PathList(kept), count
+
+
+def iter_null_separated(stream: IO[bytes]) -> Iterator[str]:
+    """Yield the NUL separated entries of a stream without reading it all into memory."""
+    pending = b""
+    while chunk := stream.read(READ_CHUNK_SIZE):
+        *entries, pending = (pending + chunk).split(b"\0")
+        for entry in entries:
+            yield entry.decode("utf-8", errors="surrogateescape")
+    if pending:
+        yield pending.decode("utf-8", errors="surrogateescape")
+
+
+@timed("modified")
 def get_repo_modified_files(repo: Repo) -> list[str]:
     """Get a list of modified files in a git repository."""
     # modified_files = repo.git.diff("--name-only").splitlines()
-    modified_files = [item.a_path for item in repo.index.diff(None)]
+    # Conflicted files show up once per unmerged stage, so drop the repeats
+    modified_files = list(dict.fromkeys(item.a_path for item in repo.index.diff(None)))
     return modified_files
 
-def get_repo_untracked_files(repo: Repo) -> list[str]:
-    """Get a list of untracked files in a git repository."""
-    # untracked_files = repo.git.ls_files("--others", "--exclude-standard").splitlines()
-    untracked_files = repo.untracked_files
-    return untracked_files
+def get_untracked_files_args(options: CheckOptions) -> list[str]:
+    """Get the `git ls-files` arguments listing the untracked files for options.untracked."""
+    # Same as `git status`: with "normal" an untracked directory is a single entry (with a trailing slash) rather than every file in it
+    ls_files_args = ["--others", "--exclude-standard", "-z"]
+    if options.untracked == "normal":
+        ls_files_args += ["--directory", "--no-empty-directory"]
+    return ls_files_args
 
 
-def is_repo_dirty(repo: Repo) -> bool:
-    """Check if a repo has any uncommited changes or is ahead/behind the remote."""
-    is_dirty = repo.is_dirty()
-    if not is_dirty:
-        # Check if the local branch is behind/ahead of the remote
-        local_branch = repo.active_branch
-        if len(repo.remotes) == 0:
-            return 0
-        remote = repo.remote()
-        remote_branch = remote.refs[local_branch.name]
-        is_dirty = local_branch.commit != remote_branch.commit
-    return is_dirty
+@timed("untracked")
+def get_repo_untracked_files(repo: Repo, options: CheckOptions = CheckOptions()) -> Tuple[list[str], int]:
+    """Get the untracked files in a git repository, streamed so only the listed ones are kept. Returns the files and the total."""
+    if options.untracked == "no":
+        return [], 0
+
+    process = repo.git.ls_files(*get_untracked_files_args(options), as_process=True)
+    try:
+        return collect_files(iter_null_separated(process.stdout), options)
+    finally:
+        process.wait()
+
+
+@timed("modified")
+def has_changes(repo: Repo, *diff_args: str) -> bool:
+    """Check for differences with `git diff --quiet`, which stops at the first changed file instead of listing them all."""
+    status, _, stderr = repo.git.diff("--quiet", *diff_args, with_extended_output=True, with_exceptions=False)
+    if status not in (0, 1):
+        from git.exc import GitCommandError
+        raise GitCommandError(["git", "diff", "--quiet", *diff_args], status, stderr)
+    return status == 1
+
+
+def inspect_repo_quick(repo: Repo, directory: str) -> StaleResult:
+    """Decide if a repository is stale, stopping at the first evidence. Used when files aren't listed, so no file lists are gathered."""
+    # Cheapest first: comparing the branch commits only reads refs, the history is only walked when they differ
+    local_branch, remote_branch, state = get_tracking_branches(repo)
+    if remote_branch is not None and local_branch.commit != remote_branch.commit:
+        ahead, behind = count_ahead_behind(repo, local_branch.path, remote_branch.path)
+        status = format_ahead_behind(local_branch.name, remote_branch.name, ahead, behind)
+        return StaleResult(directory, True, status, RepoFiles(), ahead, behind, state)
+
+    # Staged changes only need the index compared with HEAD, unstaged changes need the worktree scanned.
+    # Untracked files don't make a repo stale (see inspect_repo), so they're never looked for here.
+    is_dirty = has_changes(repo, "--cached") or has_changes(repo)
+    return StaleResult(directory, is_dirty, format_tracking_state(get_head_name(repo, local_branch), state), state=state)
+
+
+def inspect_repo(repo: Repo, directory: str, options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Gather everything reported about a repository in a single visit. (Dirty state, files, ahead/behind and the status message)"""
+    if not options.list_files:
+        return inspect_repo_quick(repo, directory)
+
+    modified, modified_count = collect_files(get_repo_modified_files(repo), options)
+    untracked, untracked_count = get_repo_untracked_files(repo, options)
+    files = RepoFiles(modified, untracked, modified_count, untracked_count)
+
+    ahead, behind = 0, 0
+    local_branch, remote_branch, state = get_tracking_branches(repo)
+    if remote_branch is not None:
+        ahead, behind = count_ahead_behind(repo, local_branch.path, remote_branch.path)
+        status = format_ahead_behind(local_branch.name, remote_branch.name, ahead, behind)
+    else:
+        status = format_tracking_state(get_head_name(repo, local_branch), state)
+
+    # Commits that differ from the remote make the repo stale even when the worktree is clean
+    with timed("modified"):
+        is_dirty = repo.is_dirty() or ahead > 0 or behind > 0
+
+    return StaleResult(directory, is_dirty, status, files, ahead, behind, state)
 
 
 # TODO: Should the depth only be checked if the parent isn't a git repo?
-def check_directory(directory: str) -> StaleResult:
+def check_directory(directory: str, options: CheckOptions = CheckOptions()) -> StaleResult:
     """Check if a directory is a git repository and if it has any uncommitted changes. Checks remote if not dirty."""
     logger.debug("Checking directory: [%s]", directory)
-    files_list = {
-        "modified": [],
-        "untracked": []
-    }
 
-    try:
-        repo = Repo(directory)
-        # Add modified and untracked files to the list
-        files_list["modified"].extend(get_repo_modified_files(repo))
-        files_list["untracked"].extend(get_repo_untracked_files(repo))
+    # The first repository opened also pays for importing GitPython
+    with timed("open"):
+        from git import Repo
+        from git.exc import InvalidGitRepositoryError
 
-        # print(f"{directory}")
-        # print(f"untracked: {len(files_list['untracked'])}, modified: {len(files_list['modified'])}")
+    try:
+        with timed("open"):
+            repo = Repo(directory)
+        with repo:
+            result = inspect_repo(repo, directory, options)
 
-        is_dirty = is_repo_dirty(repo)
-        
-        if is_dirty:
+        if result.stale:
             logger.info("Directory is dirty: [%s]", directory)
 
-        return StaleResult(directory, is_dirty, "", RepoFiles(**files_list))
-        
+        return result
+
     except InvalidGitRepositoryError:
         logger.debug("Directory is not a git repository: [%s]", directory)
-        return StaleResult(directory, False)
+        return StaleResult(directory, False, state=REPO_STATE_ERROR)
+    except Exception as e:
+        logger.error("Error checking directory: %s", e)
+        return StaleResult(directory, False, state=REPO_STATE_ERROR)
+
+
+def parse_porcelain_status(output: str, options: CheckOptions = CheckOptions()) -> PorcelainStatus:
+    """Parse the output of `git status --porcelain=v2 --branch -z` into the branch, upstream, ahead/behind and file lists."""
+    branch, upstream, oid = "", "", ""
+    ahead, behind = 0, 0
+    has_ahead_behind = False
+    changed = False
+    modified: list[str] = []
+    untracked: list[str] = []
+
+    entries = iter(output.split("\0"))
+    for entry in entries:
+        if not entry:
+            continue
+
+        kind = entry[0]
+        if kind == "#":
+            header, _, value = entry[2:].partition(" ")
+            if header == "branch.oid":
+                oid = value
+            elif header == "branch.head":
+                branch = value
+            elif header == "branch.upstream":
+                upstream = value
+            elif header == "branch.ab":
+                ahead_text, behind_text = value.split()
+                ahead, behind = int(ahead_text), -int(behind_text)
+                has_ahead_behind = True
+        elif kind in "12u":
+            # Ordinary (1), renamed/copied (2) and unmerged (u) entries all count as uncommitted changes.
+            # The path is the last space separated field, so splitting a fixed number of times keeps spaces in names intact.
+            fields = entry.split(" ", {"1": 8, "2": 9, "u": 10}[kind])
+            xy, path = fields[1], fields[-1]
+            changed = True
+            if kind == "2":
+                next(entries, None) # Renames are followed by the original path as its own entry
+            # Only changes in the worktree are listed, matching index.diff(None) in the GitPython backend
+            if xy[1] != "." or kind == "u":
+                modified.append(path)
+        elif kind == "?":
+            untracked.append(entry[2:])
+
+    # git only reports ahead/behind when the upstream it tracks actually exists
+    state = REPO_STATE_OK
+    if branch == "(detached)":
+        state = REPO_STATE_DETACHED
+        branch = oid[:7]
+    elif oid == "(initial)":
+        state = REPO_STATE_UNBORN
+    elif not upstream:
+        state = REPO_STATE_NO_UPSTREAM
+    elif not has_ahead_behind:
+        state = REPO_STATE_UPSTREAM_GONE
+
+    modified, modified_count = collect_files(modified, options)
+    untracked, untracked_count = collect_files(untracked, options)
+    return PorcelainStatus(branch, upstream, ahead, behind, changed, RepoFiles(modified, untracked, modified_count, untracked_count), state)
+
+
+def get_git_env(directory: str) -> Dict[str, str]:
+    """Get the environment for running git in a directory."""
+    # Stop git from searching the parent directories, otherwise every subdirectory of a repo would look like a repo (Repo() doesn't search either)
+    return dict(os.environ, GIT_CEILING_DIRECTORIES=os.path.dirname(os.path.abspath(directory)), LC_ALL="C")
+
+
+def decode_porcelain_status(directory: str, returncode: int, stdout: bytes, stderr: bytes) -> Union[str, None]:
+    """Decode the output of `git status`. Returns None if it failed, i.e. the directory isn't the top of a git repository."""
+    if returncode != 0:
+        # Discovery already found a repository here, so git refusing it is an error (unsupported format, corrupt index, ...)
+        logger.error("Error checking directory: git status failed for [%s]: %s", directory, stderr.decode(errors="replace").strip())
+        return None
+    return stdout.decode("utf-8", errors="surrogateescape")
+
+
+def get_porcelain_status_command(directory: str, options: CheckOptions) -> list[str]:
+    """Get the `git status` command line used by the porcelain backend."""
+    # Untracked files don't make a repo stale, so when they aren't listed git can skip looking for them altogether
+    untracked = options.untracked if options.list_files else "no"
+    return ["git", "-C", directory, *PORCELAIN_STATUS_ARGS, f"--untracked-files={untracked}"]
+
+
+@timed("status")
+def run_porcelain_status(directory: str, options: CheckOptions = CheckOptions()) -> Union[str, None]:
+    """Run `git status` once for a directory. Returns None if the directory isn't the top of a git repository."""
+    process = subprocess.run(get_porcelain_status_command(directory, options), capture_output=True, env=get_git_env(directory))
+    return decode_porcelain_status(directory, process.returncode, process.stdout, process.stderr)
+
+
+def build_porcelain_result(directory: str, output: Union[str, None], options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Build the result for a directory from its `git status` output."""
+    if output is None:
+        return StaleResult(directory, False, state=REPO_STATE_ERROR)
+
+    status = parse_porcelain_status(output, options)
+    is_dirty = status.changed or status.ahead > 0 or status.behind > 0
+    if status.state == REPO_STATE_OK:
+        message = format_ahead_behind(status.branch, status.upstream, status.ahead, status.behind)
+    else:
+        message = format_tracking_state(status.branch, status.state)
+
+    if is_dirty:
+        logger.info("Directory is dirty: [%s]", directory)
+
+    return StaleResult(directory, is_dirty, message, status.files, status.ahead, status.behind, status.state)
+
+
+def check_directory_porcelain(directory: str, options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a directory with a single `git status --porcelain=v2` call instead of GitPython. (See check_directory)"""
+    logger.debug("Checking directory: [%s]", directory)
+
+    try:
+        return build_porcelain_result(directory, run_porcelain_status(directory, options), options)
+    except Exception as e:
+        logger.error("Error checking directory: %s", e)
+        return StaleResult(directory, False, state=REPO_STATE_ERROR)
+
+
+#### Native Backend ####
+
+def resolve_git_dir(directory: str) -> Union[Tuple[str, str], None]:
+    """Find the git directory and the common directory (shared refs/objects) of a worktree. Returns None if there is no .git entry, or it can't be read."""
+    dot_git = os.path.join(directory, ".git")
+    try:
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+        elif os.path.isfile(dot_git):
+            # Worktrees and submodules use a gitfile pointing at the real git directory
+            with open(dot_git, "r", encoding="utf-8") as f:
+                content = f.read().strip()
+            if not content.startswith("gitdir:"):
+                return None
+            git_dir = os.path.join(directory, content[len("gitdir:"):].strip())
+        else:
+            return None
+
+        common_dir = git_dir
+        commondir_file = os.path.join(git_dir, "commondir")
+        if os.path.isfile(commondir_file):
+            with open(commondir_file, "r", encoding="utf-8") as f:
+                common_dir = os.path.join(git_dir, f.read().strip())
+    except (OSError, UnicodeDecodeError) as e:
+        # Left for the backend to fail on, it reports the error for this repository instead of the whole scan dying
+        logger.debug("Unable to resolve the git directory of [%s]: %s", directory, e)
+        return None
+
+    return git_dir, common_dir
+
+
+def read_packed_refs(common_dir: str) -> Dict[str, str]:
+    """Read the packed-refs file into a mapping of ref name to object id."""
+    refs: Dict[str, str] = {}
+    try:
+        with open(os.path.join(common_dir, "packed-refs"), "r", encoding="utf-8") as f:
+            for line in f:
+                # Skip the header and peeled tag lines (^<sha>)
+                if line.startswith(("#", "^")):
+                    continue
+                sha, _, name = line.strip().partition(" ")
+                refs[name] = sha
+    except FileNotFoundError:
+        pass
+    return refs
+
+
+def read_ref(common_dir: str, ref: str, packed_refs: Dict[str, str]) -> Union[str, None]:
+    """Resolve a ref to an object id from its loose file, falling back to packed-refs."""
+    try:
+        with open(os.path.join(common_dir, ref), "r", encoding="utf-8") as f:
+            value = f.read().strip()
+        if value.startswith("ref:"):
+            return None # Symbolic refs other than HEAD aren't worth following here
+        return value
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return packed_refs.get(ref)
+
+
+def read_head(git_dir: str) -> Union[str, None]:
+    """Get the ref HEAD points to. Returns None for a detached HEAD."""
+    with open(os.path.join(git_dir, "HEAD"), "r", encoding="utf-8") as f:
+        head = f.read().strip()
+    if not head.startswith("ref:"):
+        return None
+    return head[len("ref:"):].strip()
+
+
+def read_git_config(path: str) -> Dict[str, str]:
+    """Read a git config file into a flat mapping like `git config --list` ("section.subsection.key"). Includes aren't followed."""
+    config: Dict[str, str] = {}
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return config
+
+    section = ""
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+
+        if line.startswith("["):
+            header = line[1:line.rindex("]")]
+            name, _, subsection = header.partition(" ")
+            # Section names are case insensitive, subsections aren't
+            section = name.lower()
+            subsection = subsection.strip()
+            if len(subsection) >= 2 and subsection[0] == subsection[-1] == '"':
+                # Inside the quotes a backslash escapes the next character, only the outer quotes are dropped (a\"" is a")
+                section += "." + subsection[1:-1].replace("\\\\", "\0").replace("\\", "").replace("\0", "\\")
+            continue
+
+        key, equals, value = line.partition("=")
+        key = f"{section}.{key.strip().lower()}"
+        if not equals:
+            config[key] = "true" # A bare key is a boolean
+            continue
+
+        # Drop trailing comments outside of quotes, then the quotes themselves
+        result, quoted = [], False
+        for char in value.strip():
+            if char == '"':
+                quoted = not quoted
+            elif char in "#;" and not quoted:
+                break
+            else:
+                result.append(char)
+        config[key] = "".join(result).strip()
+
+    return config
+
+
+@lru_cache(maxsize=4096)
+def read_git_config_cached(path: str, mtime_ns: int, size: int) -> Dict[str, str]:
+    """Read a git config file, cached by its stat data so a changed file is read again. (See get_git_config)"""
+    return read_git_config(path)
+
+
+def get_git_config(common_dir: str) -> Dict[str, str]:
+    """Get a repository's config, only reading the file again when it changes. The returned mapping is shared, don't modify it."""
+    path = os.path.join(common_dir, "config")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    return read_git_config_cached(path, st.st_mtime_ns, st.st_size)
+
+
+def get_upstream_ref(config: Dict[str, str], branch: str) -> Union[str, None]:
+    """Get the full ref a branch tracks from branch.<name>.remote/merge, mapped through the remote's fetch refspec. None if it tracks nothing."""
+    remote = config.get(f"branch.{branch}.remote")
+    merge = config.get(f"branch.{branch}.merge")
+    if not remote or not merge:
+        return None
+    if remote == ".":
+        return merge # Tracking another local branch
+
+    # Only the last fetch refspec is kept by read_git_config, the usual setup has just the one anyway
+    refspec = config.get(f"remote.{remote}.fetch", f"+refs/heads/*:refs/remotes/{remote}/*")
+    source, _, destination = refspec.lstrip("+").partition(":")
+    if source.endswith("*") and destination.endswith("*") and merge.startswith(source[:-1]):
+        return destination[:-1] + merge[len(source) - 1:]
+    if source == merge and destination:
+        return destination
+
+    if merge.startswith("refs/heads/"):
+        return f"refs/remotes/{remote}/{merge[len('refs/heads/'):]}"
+    return None
+
+
+def read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    """Read an index v4 path prefix length. Returns the value and the new offset."""
+    byte = data[offset]
+    offset += 1
+    value = byte & 0x7F
+    while byte & 0x80:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (byte & 0x7F)
+    return value, offset
+
+
+def read_git_index(path: str) -> Union[GitIndex, None]:
+    """Parse the parts of a git index file needed to compare it against the worktree. Returns None for unsupported indexes."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    signature, version, count = struct.unpack_from(">4sII", data, 0)
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        return None
+
+    entries: list[IndexEntry] = []
+    offset = 12
+    previous_path = b""
+    for _ in range(count):
+        (_, _, mtime_s, mtime_ns, _, _, mode, _, _, size) = struct.unpack_from(">10I", data, offset)
+        flags, = struct.unpack_from(">H", data, offset + 60)
+        entry_start = offset
+        offset += 62
+        extended = 0
+        if version >= 3 and flags & INDEX_FLAG_EXTENDED:
+            extended, = struct.unpack_from(">H", data, offset)
+            offset += 2
+
+        if version == 4:
+            strip, offset = read_varint(data, offset)
+            end = data.index(b"\0", offset)
+            name = previous_path[:len(previous_path) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            end = data.index(b"\0", offset)
+            name = data[offset:end]
+            # Entries are NUL padded to a multiple of 8 bytes
+            offset = entry_start + ((end - entry_start + 8) & ~7)
+        previous_path = name
+
+        # Unmerged entries (stage != 0), assume-valid, skip-worktree and intent-to-add can't be judged from stat data alone
+        if flags & (INDEX_FLAG_STAGE | INDEX_FLAG_ASSUME_VALID) or extended & (INDEX_FLAG_SKIP_WORKTREE | INDEX_FLAG_INTENT_TO_ADD):
+            return None
+        entries.append(IndexEntry(os.fsdecode(name), mode, mtime_s, mtime_ns, size))
+
+    # Extensions follow the entries and precede the trailing checksum
+    tree = None
+    while offset + 8 <= len(data) - 20:
+        extension, length = struct.unpack_from(">4sI", data, offset)
+        offset += 8
+        if extension == b"TREE":
+            # The root of the cache tree is the first record: "\0<entry count> <subtrees>\n<sha>". -1 entries means it's invalidated.
+            end = data.index(b"\n", offset)
+            entry_count = int(data[data.index(b"\0", offset) + 1:end].split(b" ")[0])
+            if entry_count >= 0:
+                tree = data[end + 1:end + 21].hex()
+        elif extension == b"link":
+            return None # Split indexes keep entries in a second file
+        offset += length
+
+    return GitIndex(entries, tree)
+
+
+def read_loose_object(common_dir: str, sha: str) -> Union[Tuple[str, bytes], None]:
+    """Read a loose object. Returns the object type and content."""
+    try:
+        with open(os.path.join(common_dir, "objects", sha[:2], sha[2:]), "rb") as f:
+            data = zlib.decompress(f.read())
+    except FileNotFoundError:
+        return None
+    header, _, content = data.partition(b"\0")
+    return header.split(b" ")[0].decode(), content
+
+
+def read_packed_object(common_dir: str, sha: str) -> Union[Tuple[str, bytes], None]:
+    """Read a non-delta object from a pack file. Returns the object type and content."""
+    pack_dir = os.path.join(common_dir, "objects", "pack")
+    try:
+        names = os.listdir(pack_dir)
+    except FileNotFoundError:
+        return None
+
+    binary_sha = bytes.fromhex(sha)
+    for name in names:
+        if not name.endswith(".idx"):
+            continue
+        with open(os.path.join(pack_dir, name), "rb") as f:
+            idx = f.read()
+        if idx[:8] != b"\377tOc\0\0\0\2":
+            continue # Only version 2 pack indexes
+
+        # The fanout table bounds the range of the sorted sha list that can contain the object
+        fanout = struct.unpack_from(">256I", idx, 8)
+        total = fanout[255]
+        low = fanout[binary_sha[0] - 1] if binary_sha[0] > 0 else 0
+        high = fanout[binary_sha[0]]
+        shas_start = 8 + 256 * 4
+        while low < high:
+            middle = (low + high) // 2
+            candidate = idx[shas_start + middle * 20:shas_start + middle * 20 + 20]
+            if candidate < binary_sha:
+                low = middle + 1
+            elif candidate > binary_sha:
+                high = middle
+            else:
+                break
+        else:
+            continue
+
+        offsets_start = shas_start + total * 24 # Skip the shas (20 bytes) and crc32s (4 bytes)
+        pack_offset, = struct.unpack_from(">I", idx, offsets_start + middle * 4)
+        if pack_offset & 0x80000000:
+            large_offset_index = pack_offset & 0x7FFFFFFF
+            pack_offset, = struct.unpack_from(">Q", idx, offsets_start + total * 4 + large_offset_index * 8)
+
+        with open(os.path.join(pack_dir, name[:-len(".idx")] + ".pack"), "rb") as f:
+            f.seek(pack_offset)
+            header = f.read(16)
+            byte = header[0]
+            object_type = (byte >> 4) & 0x7
+            header_length = 1
+            while byte & 0x80:
+                byte = header[header_length]
+                header_length += 1
+            if object_type not in PACK_OBJECT_TYPES:
+                return None # Deltified, resolving them isn't worth it here
+            f.seek(pack_offset + header_length)
+            decompressor = zlib.decompressobj()
+            content = b""
+            while not decompressor.eof:
+                chunk = f.read(8192)
+                if not chunk:
+                    break
+                content += decompressor.decompress(chunk)
+            return PACK_OBJECT_TYPES[object_type], content
+
+    return None
+
+
+def read_commit_tree(common_dir: str, sha: str) -> Union[str, None]:
+    """Get the tree id of a commit from the object database without spawning git."""
+    obj = read_loose_object(common_dir, sha) or read_packed_object(common_dir, sha)
+    if obj is None or obj[0] != "commit":
+        return None
+    first_line = obj[1].split(b"\n", 1)[0]
+    if not first_line.startswith(b"tree "):
+        return None
+    return first_line[len(b"tree "):].decode()
+
+
+def is_worktree_clean(worktree: str, index: GitIndex, index_mtime_ns: int) -> bool:
+    """Stat every index entry and compare it against the cached stat data. (The same check git uses to skip hashing unchanged files)"""
+    for entry in index.entries:
+        if entry.mode == GITLINK_MODE:
+            return False # Submodules need their own status, leave them to GitPython
+
+        try:
+            st = os.lstat(os.path.join(worktree, entry.path))
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+        if (st.st_size & 0xFFFFFFFF) != entry.size or int(st.st_mtime) != entry.mtime_s:
+            return False
+        # git may have been built without nanosecond timestamps
+        if entry.mtime_ns and st.st_mtime_ns % 1_000_000_000 != entry.mtime_ns:
+            return False
+        if stat.S_ISLNK(st.st_mode) != stat.S_ISLNK(entry.mode) or bool(st.st_mode & 0o100) != bool(entry.mode & 0o100):
+            return False
+        # "Racily clean": modified in the same instant the index was written, the stat data can't be trusted
+        if st.st_mtime_ns >= index_mtime_ns:
+            return False
+
+    return True
+
+
+@timed("native")
+def looks_clean_native(directory: str) -> bool:
+    """Decide if a repository is clean and in sync with its remote by reading .git directly."""
+    git_dirs = resolve_git_dir(directory)
+    if git_dirs is None:
+        return False # Bare repositories and anything else unusual are left to GitPython
+    git_dir, common_dir = git_dirs
+
+    head_ref = read_head(git_dir)
+    if head_ref is None or not head_ref.startswith("refs/heads/"):
+        return False
+
+    packed_refs = read_packed_refs(common_dir)
+    head_sha = read_ref(common_dir, head_ref, packed_refs)
+    if head_sha is None:
+        return False # Unborn branch
+
+    # Branches without an upstream are left to GitPython so their state gets reported
+    upstream = get_upstream_ref(get_git_config(common_dir), head_ref[len("refs/heads/"):])
+    if upstream is None or read_ref(common_dir, upstream, packed_refs) != head_sha:
+        return False
+
+    index_path = os.path.join(git_dir, "index")
+    try:
+        index_mtime_ns = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    index = read_git_index(index_path)
+    if index is None or index.tree is None:
+        return False
+
+    # Staged changes: the cache tree holds the tree the index would commit, so it must match HEAD's tree
+    if read_commit_tree(common_dir, head_sha) != index.tree:
+        return False
+
+    return is_worktree_clean(directory, index, index_mtime_ns)
+
+
+@timed("untracked")
+def list_untracked_files_native(directory: str, options: CheckOptions = CheckOptions()) -> Tuple[PathList, int]:
+    """Get the untracked files of a clean repository with a single `git ls-files`, without opening it with GitPython. (See get_repo_untracked_files)"""
+    process = subprocess.Popen(["git", "-C", directory, "ls-files", *get_untracked_files_args(options)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=get_git_env(directory))
+    try:
+        files = collect_files(iter_null_separated(process.stdout), options)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"git ls-files failed with exit code {returncode}")
+    return files
+
+
+def check_directory_native(directory: str, options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a directory by reading .git directly, only falling back to GitPython (check_directory) if it looks stale."""
+    try:
+        clean = looks_clean_native(directory)
+    except Exception as e:
+        # Anything unexpected (corrupt files, unusual layouts) is left for GitPython to judge
+        logger.debug("Native check failed for [%s]: %s", directory, e)
+        clean = False
+
+    if clean:
+        logger.debug("Directory is clean: [%s]", directory)
+        if not options.list_files or options.untracked == "no":
+            return StaleResult(directory, False)
+        # Untracked files never make a repository stale, but they're still listed (for every repository in machine readable output)
+        try:
+            untracked, untracked_count = list_untracked_files_native(directory, options)
+            return StaleResult(directory, False, files=RepoFiles(untracked=untracked, untracked_count=untracked_count))
+        except Exception as e:
+            logger.debug("Native untracked listing failed for [%s]: %s", directory, e)
+
+    return check_directory(directory, options)
+
+
+#### Repository State ####
+
+@timed("state")
+def detect_repo_state(directory: str) -> Union[str, None]:
+    """Detect the states visible from the git directory alone: bare repositories and unfinished operations. None for anything else."""
+    git_dirs = resolve_git_dir(directory)
+    if git_dirs is None:
+        if all(os.path.exists(os.path.join(directory, name)) for name in BARE_REPO_ENTRIES):
+            return REPO_STATE_BARE
+        return None
+
+    for marker, state in REPO_OPERATION_MARKERS:
+        if os.path.exists(os.path.join(git_dirs[0], marker)):
+            return state
+    return None
+
+
+def get_repo_state_result(directory: str, state: Union[str, None], options: CheckOptions) -> Union[StaleResult, None]:
+    """Get the result for a repository whose state already decides it, so none of the expensive checks run. None if it still needs checking."""
+    if state == REPO_STATE_BARE:
+        return StaleResult(directory, False, state=state)
+    # An unfinished operation is stale no matter what, the worktree is only worth inspecting to list its files
+    if state in REPO_OPERATION_MESSAGES and not options.list_files:
+        logger.info("Directory is dirty: [%s]", directory)
+        return StaleResult(directory, True, REPO_OPERATION_MESSAGES[state], state=state)
+    return None
+
+
+def apply_repo_state(result: StaleResult, state: Union[str, None]) -> StaleResult:
+    """Apply a state found by detect_repo_state to the result of a full check."""
+    if state not in REPO_OPERATION_MESSAGES:
+        return result
+    return result._replace(stale=True, status_message=REPO_OPERATION_MESSAGES[state], state=state)
+
+
+#### Branch Audit ####
+
+def parse_branch_audit(output: str) -> list[BranchStatus]:
+    """Parse the `git for-each-ref` branch listing, keeping only the branches that are out of sync or have no usable upstream."""
+    branches: list[BranchStatus] = []
+    for line in output.splitlines():
+        if not line:
+            continue
+        refname, upstream, track = line.split("\0")
+        name = refname[len("refs/heads/"):]
+
+        ahead, behind = 0, 0
+        state = REPO_STATE_OK
+        if not upstream:
+            state = REPO_STATE_NO_UPSTREAM
+        elif track == "gone":
+            state = REPO_STATE_UPSTREAM_GONE
+        else:
+            # "ahead 1", "behind 2" or "ahead 1, behind 2". Empty when in sync.
+            for part in filter(None, track.split(", ")):
+                direction, _, count = part.partition(" ")
+                if direction == "ahead":
+                    ahead = int(count)
+                elif direction == "behind":
+                    behind = int(count)
+
+        if state != REPO_STATE_OK or ahead or behind:
+            branches.append(BranchStatus(name, upstream, ahead, behind, state))
+    return branches
+
+
+def get_branch_audit_command(directory: str) -> list[str]:
+    """Get the command line listing every branch of a repository."""
+    return ["git", "-C", directory, *BRANCH_AUDIT_ARGS]
+
+
+@timed("audit")
+def audit_branches(directory: str) -> list[BranchStatus]:
+    """Get every local branch that is ahead of, behind or missing its upstream, with a single git process."""
+    process = subprocess.run(get_branch_audit_command(directory), capture_output=True, env=get_git_env(directory), check=True)
+    return parse_branch_audit(process.stdout.decode("utf-8", errors="surrogateescape"))
+
+
+def add_branch_audit(result: StaleResult, branches: list[BranchStatus]) -> StaleResult:
+    """Add the audited branches to a result. Any out of sync branch makes the repository stale."""
+    if branches:
+        logger.info("Directory has out of sync branches: [%s]", result.directory)
+    return result._replace(stale=result.stale or bool(branches), branches=tuple(branches))
+
+
+def check_repository(directory: str, backend: str = "gitpython", options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a repository with the given backend, auditing all of its branches if asked to. Records the phase timings if asked to."""
+    with record_timings(options.timings, options.cpu_times) as timings:
+        result = check_repository_untimed(directory, backend, options)
+    return result._replace(timings=timings) if options.timings else result
+
+
+def check_repository_untimed(directory: str, backend: str = "gitpython", options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a repository with the given backend, auditing all of its branches if asked to. (See check_repository)"""
+    state = detect_repo_state(directory)
+    result = get_repo_state_result(directory, state, options)
+    if result is None:
+        result = apply_repo_state(BACKENDS[backend](directory, options), state)
+    if not options.all_branches or state == REPO_STATE_BARE:
+        return result
+
+    try:
+        return add_branch_audit(result, audit_branches(directory))
+    except Exception as e:
+        logger.error("Error auditing branches: %s", e)
+        return result
+
+
+#### Backends ####
+
+# Functions used to check a single directory, selectable with --backend
+BACKENDS = {
+    "gitpython": check_directory,
+    "porcelain": check_directory_porcelain,
+    "native": check_directory_native,
+}
+
+
+#### Discovery ####
+
+def classify_repository(entries: Iterable[os.DirEntry]) -> Union[str, None]:
+    """Classify a directory's layout from its entries. Returns one of the REPO_LAYOUT_* constants or None if it isn't a repository."""
+    names = set()
+    for entry in entries:
+        if entry.name == ".git":
+            return REPO_LAYOUT_WORKTREE if entry.is_dir() else REPO_LAYOUT_GITFILE
+        names.add(entry.name)
+
+    if BARE_REPO_ENTRIES <= names:
+        return REPO_LAYOUT_BARE
+    return None
+
+
+def detect_repository(directory: str) -> Union[str, None]:
+    """Cheaply check if a directory is a repository with a single scandir, before paying for a Repo object."""
+    try:
+        with os.scandir(directory) as it:
+            return classify_repository(it)
+    except OSError:
+        return None
+
+
+def is_ignored(path: str, name: str, ignore: Iterable[str]) -> bool:
+    """Check if a directory matches any of the ignore globs, by name or by path relative to the root."""
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern) for pattern in ignore)
+
+
+def walk_directories(root: str, max_depth: int, ignore: Iterable[str] = (), nested: bool = False) -> Iterator[str]:
+    """Yield the directories up to max_depth levels below root. Repositories are yielded but not descended into unless nested is set."""
+    ignore = tuple(ignore) # Matched against every entry, so it has to be iterable more than once
+    stack = [(root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.debug("Unable to read directory [%s]: %s", directory, e)
+            continue
+
+        # Only directories below the root get pruned here, the root is handled by discover_directories
+        if depth > 0 and not nested and classify_repository(entries) is not None:
+            continue
+
+        children = []
+        for entry in entries:
+            if entry.name == ".git" or not entry.is_dir():
+                continue
+            if is_ignored(os.path.relpath(entry.path, root), entry.name, ignore):
+                logger.debug("Ignoring directory: [%s]", entry.path)
+                continue
+
+            yield entry.path
+            # Like os.walk, symlinked directories are checked but never followed
+            if depth + 1 < max_depth and not entry.is_symlink():
+                children.append((entry.path, depth + 1))
+
+        stack.extend(reversed(children))
+
+
+def iter_discover_directories(root: str, max_depth: int, ignore: Iterable[str] = (), nested: bool = False) -> Iterator[str]:
+    """Yield the directories to check. If root is a repository itself it's the only directory, unless nested repositories were requested."""
+    if detect_repository(root) is not None:
+        yield root
+        if not nested:
+            return
+
+    yield from walk_directories(root, max_depth, ignore, nested)
+
+
+def discover_directories(root: str, max_depth: int, ignore: Iterable[str] = (), nested: bool = False) -> list[str]:
+    """Get the directories to check. (See iter_discover_directories)"""
+    return list(iter_discover_directories(root, max_depth, ignore, nested))
+
+
+#### Cache ####
+
+def get_cache_path() -> str:
+    """Get the path of the scan cache file, following the XDG base directory spec."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "stale-repo-checker", "scan-cache.jsonl")
+
+
+def result_to_dict(result: StaleResult) -> dict:
+    """Convert a result into plain JSON serializable types."""
+    data = result._asdict()
+    data["files"] = {**result.files._asdict(), "modified": list(result.files.modified), "untracked": list(result.files.untracked)}
+    data["branches"] = [branch._asdict() for branch in result.branches]
+    data["timings"] = dict(result.timings or {})
+    return data
+
+
+def result_from_dict(data: dict) -> StaleResult:
+    """Rebuild a result converted with result_to_dict."""
+    branches = tuple(BranchStatus(**branch) for branch in data.get("branches", []))
+    files = data["files"]
+    files = RepoFiles(PathList(files["modified"]), PathList(files["untracked"]), files["modified_count"], files["untracked_count"])
+    return StaleResult(**{**data, "files": files, "branches": branches, "timings": data.get("timings") or None})
+
+
+def get_repo_fingerprint(directory: str) -> Union[list, None]:
+    """Get the size and mtime of the git files that change whenever the result of a check could. Returns None if the layout isn't supported."""
+    git_dirs = resolve_git_dir(directory)
+    if git_dirs is None:
+        return None
+    git_dir, common_dir = git_dirs
+
+    paths = [
+        os.path.join(git_dir, "HEAD"),
+        os.path.join(git_dir, "index"),
+        os.path.join(common_dir, "packed-refs"),
+        os.path.join(common_dir, "config"),
+    ]
+    head_ref = read_head(git_dir)
+    if head_ref is not None:
+        paths.append(os.path.join(common_dir, head_ref))
+        if head_ref.startswith("refs/heads/"):
+            upstream = get_upstream_ref(get_git_config(common_dir), head_ref[len("refs/heads/"):])
+            if upstream is not None:
+                paths.append(os.path.join(common_dir, upstream))
+
+    fingerprint = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            fingerprint.append([st.st_mtime_ns, st.st_size])
+        except OSError:
+            fingerprint.append(None)
+    return fingerprint
+
+
+def is_worktree_unchanged(directory: str) -> bool:
+    """Check that no tracked file was touched since the index was written. Editing files doesn't touch .git, so the fingerprint alone can't tell."""
+    git_dirs = resolve_git_dir(directory)
+    if git_dirs is None:
+        return False
+    index_path = os.path.join(git_dirs[0], "index")
+    index_mtime_ns = os.stat(index_path).st_mtime_ns
+    index = read_git_index(index_path)
+    return index is not None and is_worktree_clean(directory, index, index_mtime_ns)
+
+
+def get_cache_options(options: CheckOptions) -> list:
+    """Get the options a cached result depends on. Recording timings doesn't change the result."""
+    return list(options._replace(timings=False, cpu_times=False))
+
+
+class ScanCache:
+    """Results of previous scans, keyed by repository and invalidated by the repository's fingerprint."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self.seen: Set[str] = set()
+
+    def load(self) -> "ScanCache":
+        """Load the cache file if there is one. A corrupt cache is discarded."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry["directory"]] = entry
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Discarding unreadable scan cache [%s]: %s", self.path, e)
+            self.entries = {}
+        return self
+
+    def lookup(self, directory: str, backend: str, options: CheckOptions = CheckOptions()) -> Tuple[Union[StaleResult, None], Union[list, None]]:
+        """Get the cached result of a directory if it's still valid, along with the current fingerprint to store with a fresh result."""
+        key = os.path.abspath(directory)
+        self.seen.add(key)
+        try:
+            fingerprint = get_repo_fingerprint(directory)
+            entry = self.entries.get(key)
+            if fingerprint is None or entry is None or entry["fingerprint"] != fingerprint:
+                return None, fingerprint
+            # Results also depend on how the repo was checked
+            if entry["backend"] != backend or entry.get("options") != get_cache_options(options):
+                return None, fingerprint
+            # The fingerprint only covers the active branch and its upstream
+            if options.all_branches:
+                return None, None
+
+            # Only clean results are reused. Stale repos are re-checked so the file lists and counts stay current.
+            result = result_from_dict(entry["result"])
+            if result.stale or not is_worktree_unchanged(directory):
+                return None, fingerprint
+            # New untracked files don't touch .git or the tracked files, so the untracked list is always taken again
+            if options.list_files and options.untracked != "no":
+                untracked, untracked_count = list_untracked_files_native(directory, options)
+                result = result._replace(files=result.files._replace(untracked=untracked, untracked_count=untracked_count))
+            return result._replace(directory=directory), fingerprint
+        except Exception as e:
+            logger.debug("Scan cache lookup failed for [%s]: %s", directory, e)
+            return None, None
+
+    def store(self, directory: str, backend: str, fingerprint: Union[list, None], result: StaleResult, options: CheckOptions = CheckOptions()) -> None:
+        """Remember the result of a check. Failed checks aren't remembered, so the error shows up again next time."""
+        if fingerprint is None or result.state == REPO_STATE_ERROR:
+            return
+        key = os.path.abspath(directory)
+        # The timings are only meaningful for the scan that took them
+        self.entries[key] = {"directory": key, "backend": backend, "options": get_cache_options(options), "fingerprint": fingerprint, "result": result_to_dict(result._replace(timings=None))}
+
+    def save(self, root: str) -> None:
+        """Write the cache back, evicting repositories that disappeared or weren't found under root this time."""
+        root = os.path.join(os.path.abspath(root), "")
+        for key in list(self.entries):
+            if (key.startswith(root) and key not in self.seen) or not os.path.isdir(key):
+                del self.entries[key]
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, self.path) # Atomic, so concurrent runs never see a partial file
+
+
+#### Fetching ####
+
+def get_remote_host(url: str) -> str:
+    """Get the host a remote URL connects to, used to group fetches. Local remotes have no host."""
+    if "://" in url:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == "file":
+            return ""
+        return f"{parts.scheme}://{parts.netloc}"
+
+    # scp-like syntax ([user@]host:path), as long as the colon comes before any slash (otherwise it's a local path)
+    host, colon, _ = url.partition(":")
+    if colon and "/" not in host and len(host) > 1: # Single letters are Windows drives
+        return f"ssh://{host}"
+    return ""
+
+
+def get_fetch_remote(directory: str) -> Union[Tuple[str, str], None]:
+    """Get the remote the active branch tracks (origin if it isn't configured) and its URL. Returns None if there's nothing to fetch."""
+    git_dirs = resolve_git_dir(directory)
+    if git_dirs is None:
+        return None
+    git_dir, common_dir = git_dirs
+
+    config = get_git_config(common_dir)
+    head_ref = read_head(git_dir)
+    remote = "origin"
+    if head_ref is not None and head_ref.startswith("refs/heads/"):
+        remote = config.get(f"branch.{head_ref[len('refs/heads/'):]}.remote", remote)
+
+    url = config.get(f"remote.{remote}.url")
+    if url is None:
+        return None
+    return remote, url
+
+
+def get_fetch_env(control_dir: str) -> Dict[str, str]:
+    """Get the environment for fetching. SSH connections are multiplexed so repos on the same host share one connection."""
+    # Never stop to ask for credentials, a prompt would just sit there until the timeout
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0", LC_ALL="C")
+    if "GIT_SSH_COMMAND" not in env and "GIT_SSH" not in env:
+        control_path = os.path.join(control_dir, "%C")
+        env["GIT_SSH_COMMAND"] = f"ssh -o BatchMode=yes -o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={FETCH_CONTROL_PERSIST}"
+    return env
+
+
+def fetch_repository(directory: str, remote: str, timeout: float, env: Dict[str, str]) -> FetchResult:
+    """Fetch a single remote of a repository, giving up after timeout seconds."""
+    logger.debug("Fetching [%s] from %s", directory, remote)
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(["git", "-C", directory, "fetch", "--quiet", remote], capture_output=True, env=env, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return FetchResult(directory, False, f"timed out after {timeout:g}s", time.perf_counter() - start)
+    except OSError as e:
+        return FetchResult(directory, False, str(e), time.perf_counter() - start)
+
+    if process.returncode != 0:
+        return FetchResult(directory, False, process.stderr.decode(errors="replace").strip(), time.perf_counter() - start)
+    return FetchResult(directory, True, duration=time.perf_counter() - start)
+
+
+def fetch_repositories(directories: list[str], jobs: int = 1, timeout: float = 60, stats: Union[ScanStats, None] = None) -> list[FetchResult]:
+    """Fetch the tracked remote of every repository concurrently, so the ahead/behind checks compare against the current remote state."""
+    if stats is None:
+        stats = ScanStats()
+
+    # Group by host. The first fetch to each host runs on its own and leaves an SSH master connection behind that the rest of the group reuse.
+    results: list[FetchResult] = []
+    groups: Dict[str, list[Tuple[str, str]]] = {}
+    for directory in directories:
+        try:
+            remote = get_fetch_remote(directory)
+        except (OSError, UnicodeDecodeError) as e:
+            # e.g. a worktree whose git directory was removed, it fails on its own instead of taking the whole run down
+            results.append(FetchResult(directory, False, str(e)))
+            continue
+        if remote is None:
+            logger.debug("Nothing to fetch for [%s]", directory)
+            continue
+        name, url = remote
+        groups.setdefault(get_remote_host(url), []).append((directory, name))
+
+    first = [group[0] for host, group in groups.items() if host]
+    rest = [item for host, group in groups.items() for item in (group if not host else group[1:])]
+
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix="stale-fetch-") as control_dir, ThreadPoolExecutor(max_workers=max(jobs, 1), thread_name_prefix="stale-fetch") as executor:
+        env = get_fetch_env(control_dir)
+        for batch in (first, rest):
+            results.extend(executor.map(lambda item: fetch_repository(item[0], item[1], timeout, env), batch))
+
+    for result in results:
+        if result.ok:
+            stats.fetched += 1
+        else:
+            stats.fetch_failed += 1
+            logger.warning("Unable to fetch [%s]: %s", result.directory, result.message)
+    return results
+
+
+#### Scanning ####
+
+def get_default_jobs() -> int:
+    """Get the default number of concurrent checks. (One per CPU)"""
+    return os.cpu_count() or 1
+
+
+def iter_scan_directories(directories: Iterable[str], jobs: int = 1, use_processes: bool = False, backend: str = "gitpython", stats: Union[ScanStats, None] = None, cache: Union[ScanCache, None] = None, options: CheckOptions = CheckOptions()) -> Iterator[StaleResult]:
+    """Check directories as they're discovered, concurrently if jobs > 1. Results are yielded as each repository finishes. Directories that aren't repositories are skipped."""
+    checker = partial(check_repository, backend=backend, options=options)
+    if stats is None:
+        stats = ScanStats()
+
+    def check_candidate(directory: str, process_pool: Union[Executor, None] = None) -> Tuple[Union[StaleResult, None], bool]:
+        """Check a single candidate. Returns the result (None if it isn't a repository) and whether it came from the cache."""
+        if detect_repository(directory) is None:
+            return None, False
+
+        cached, fingerprint = None, None
+        if cache is not None:
+            start = time.perf_counter()
+            cached, fingerprint = cache.lookup(directory, backend, options)
+            lookup_time = time.perf_counter() - start
+        if cached is not None:
+            return add_timing(cached, "cache", lookup_time) if options.timings else cached, True
+
+        if process_pool is not None:
+            result = process_pool.submit(checker, directory).result()
+        else:
+            result = checker(directory)
+        if cache is not None:
+            cache.store(directory, backend, fingerprint, result, options)
+            if options.timings:
+                result = add_timing(result, "cache", lookup_time)
+        return result, False
+
+    def account(outcome: Tuple[Union[StaleResult, None], bool]) -> Iterator[StaleResult]:
+        """Update the stats for a finished candidate. Done on the consuming thread so the counters don't race."""
+        result, cached = outcome
+        stats.candidates += 1
+        if result is None:
+            stats.skipped += 1
+            return
+        stats.cached += cached
+        yield result
+
+    if jobs <= 1:
+        for directory in directories:
+            yield from account(check_candidate(directory))
+        return
+
+    # Most of the time is spent waiting on git subprocesses and the disk, so threads are usually enough.
+    # Processes sidestep the GIL for the pure-python parts (GitPython's parsing) at the cost of startup time,
+    # the threads still do detection and cache lookups and just wait on the process running the check.
+    logger.debug("Checking directories with %i %s", jobs, "processes" if use_processes else "threads")
+    process_pool = None
+    if use_processes:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Workers are started lazily from the checker threads. Forking while those threads hold locks (logging, GitPython) can deadlock the
+        # child, so the workers come from a fork server (a clean single threaded process) or are spawned where there's none.
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        process_pool = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(start_method), initializer=setup_worker_logging, initargs=(logger.getEffectiveLevel(),))
+    finished: queue.SimpleQueue[Future] = queue.SimpleQueue()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="stale-check") as executor:
+            submitted, received = 0, 0
+            for directory in directories:
+                executor.submit(check_candidate, directory, process_pool).add_done_callback(finished.put)
+                submitted += 1
+                # Hand out whatever finished in the meantime, so results flow while discovery is still running
+                while not finished.empty():
+                    received += 1
+                    yield from account(finished.get().result())
+
+            while received < submitted:
+                received += 1
+                yield from account(finished.get().result())
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+
+def scan_directories(directories: list[str], jobs: int = 1, use_processes: bool = False, backend: str = "gitpython", stats: Union[ScanStats, None] = None, cache: Union[ScanCache, None] = None, options: CheckOptions = CheckOptions()) -> list[StaleResult]:
+    """Check all of the given directories, concurrently if jobs > 1. Results are returned in the same order as the directories. Directories that aren't repositories are skipped."""
+    order = {directory: index for index, directory in enumerate(directories)}
+    results = list(iter_scan_directories(directories, jobs, use_processes, backend, stats, cache, options))
+    results.sort(key=lambda result: order[result.directory])
+    return results
+
+
+#### Async Scanning ####
+
+async def check_directory_async(directory: str, limit: asyncio.Semaphore, options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a directory with the porcelain backend, running `git status` as an asyncio subprocess. (See check_directory_porcelain)"""
+    # Each check runs as its own task, so the timings of concurrent checks don't mix
+    with record_timings(options.timings) as timings:
+        result = await check_directory_async_untimed(directory, limit, options)
+    return result._replace(timings=timings) if options.timings else result
+
+
+async def check_directory_async_untimed(directory: str, limit: asyncio.Semaphore, options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a directory asynchronously. (See check_directory_async)"""
+    logger.debug("Checking directory: [%s]", directory)
+    import asyncio
+
+    try:
+        # Reads the gitfile and stats the operation markers, off the event loop like detection (see scan_directories_async)
+        state = await asyncio.to_thread(detect_repo_state, directory)
+        result = get_repo_state_result(directory, state, options)
+        if result is not None and (not options.all_branches or state == REPO_STATE_BARE):
+            return result
+
+        if result is None:
+            # Time spent waiting for a slot counts too, that's what makes a scan slow with many repos
+            with timed("status"):
+                async with limit:
+                    process = await asyncio.create_subprocess_exec(
+                        *get_porcelain_status_command(directory, options),
+                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=get_git_env(directory),
+                    )
+                    stdout, stderr = await process.communicate()
+            result = apply_repo_state(build_porcelain_result(directory, decode_porcelain_status(directory, process.returncode, stdout, stderr), options), state)
+
+        if options.all_branches:
+            with timed("audit"):
+                async with limit:
+                    process = await asyncio.create_subprocess_exec(
+                        *get_branch_audit_command(directory),
+                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=get_git_env(directory),
+                    )
+                    stdout, stderr = await process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(f"git for-each-ref failed: {stderr.decode(errors='replace').strip()}")
+            result = add_branch_audit(result, parse_branch_audit(stdout.decode("utf-8", errors="surrogateescape")))
+
+        return result
     except Exception as e:
         logger.error("Error checking directory: %s", e)
-        return StaleResult(directory, False)
+        return StaleResult(directory, False, state=REPO_STATE_ERROR)
+
+
+async def check_directory_cached_async(directory: str, limit: asyncio.Semaphore, cache: ScanCache, stats: ScanStats, options: CheckOptions = CheckOptions()) -> StaleResult:
+    """Check a directory asynchronously, reusing the cached result if the repository hasn't changed."""
+    import asyncio
+    start = time.perf_counter()
+    cached, fingerprint = await asyncio.to_thread(cache.lookup, directory, "porcelain", options)
+    lookup_time = time.perf_counter() - start
+    if cached is not None:
+        stats.cached += 1
+        return add_timing(cached, "cache", lookup_time) if options.timings else cached
+
+    result = await check_directory_async(directory, limit, options)
+    cache.store(directory, "porcelain", fingerprint, result, options)
+    return add_timing(result, "cache", lookup_time) if options.timings else result
+
+
+async def scan_directories_async(directories: list[str], jobs: int = 1, stats: Union[ScanStats, None] = None, cache: Union[ScanCache, None] = None, options: CheckOptions = CheckOptions()) -> AsyncIterator[StaleResult]:
+    """Check the given directories with at most `jobs` git processes in flight. Results are yielded as each repository finishes."""
+    import asyncio
+    if stats is None:
+        stats = ScanStats()
+    stats.candidates += len(directories)
+
+    # Detection only stats the directory, keep it off the event loop so slow filesystems don't stall the running checks
+    layouts = await asyncio.gather(*(asyncio.to_thread(detect_repository, directory) for directory in directories))
+    repositories = [directory for directory, layout in zip(directories, layouts) if layout is not None]
+    stats.skipped += len(directories) - len(repositories)
+
+    limit = asyncio.Semaphore(jobs)
+    if cache is None:
+        checks = [check_directory_async(directory, limit, options) for directory in repositories]
+    else:
+        checks = [check_directory_cached_async(directory, limit, cache, stats, options) for directory in repositories]
+    for check in asyncio.as_completed(checks):
+        yield await check
+
+
+async def scan_root_async(root: str, max_depth: int, ignore: list[str], nested: bool, jobs: int, stats: ScanStats, cache: Union[ScanCache, None] = None, on_result: Union[Callable[[StaleResult], None], None] = None, options: CheckOptions = CheckOptions()) -> list[StaleResult]:
+    """Discover and check every repository under root without blocking on any single git process. on_result is called as each repository finishes."""
+    import asyncio
+    directories = await asyncio.to_thread(discover_directories, root, max_depth, ignore, nested)
+    logger.debug("Discovered %i directories", len(directories))
+
+    results = []
+    async for result in scan_directories_async(directories, jobs, stats, cache, options):
+        if on_result is not None:
+            on_result(result)
+        results.append(result)
+    return results
+
+
+#### Watching ####
+
+class Inotify:
+    """A minimal binding of Linux's inotify through ctypes, there's none in the standard library. Raises OSError where it isn't available."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify isn't available on this platform")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """Watch a directory, returning the watch descriptor. The same directory always gets the same descriptor."""
+        import ctypes
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read_events(self, timeout: Union[float, None]) -> list[Tuple[int, int, str]]:
+        """Wait up to timeout seconds (None waits forever) for events, returning every (watch descriptor, mask, name) available."""
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_CHUNK_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def iter_watch_directories(directory: str, root: str, ignore: list[str]) -> Iterator[str]:
+    """Yield the worktree directories of a repository, the same ones discovery would walk. Nested repositories are left to their own watches."""
+    stack = [directory]
+    while stack:
+        path = stack.pop()
+        yield path
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name == ".git" or not entry.is_dir(follow_symlinks=False):
+                continue
+            if is_ignored(os.path.relpath(entry.path, root), entry.name, ignore) or detect_repository(entry.path) is not None:
+                continue
+            stack.append(entry.path)
+
+
+def get_watch_signature(directory: str, root: str, ignore: list[str]) -> Union[int, None]:
+    """Hash the stat data of everything a check looks at, so polling can tell when a repository changed. None if it isn't a repository anymore."""
+    git_dirs = resolve_git_dir(directory)
+    if git_dirs is None:
+        return None
+
+    # The fingerprint covers HEAD, the index, refs and config. The git directory's own mtime changes when MERGE_HEAD & co. come and go.
+    try:
+        signature = [repr(get_repo_fingerprint(directory)), os.stat(git_dirs[0]).st_mtime_ns]
+    except (OSError, UnicodeDecodeError) as e:
+        # e.g. a worktree whose git directory was removed, it's treated like any other directory that stopped being a repository
+        logger.debug("Unable to read the git directory of [%s]: %s", directory, e)
+        return None
+    for path in iter_watch_directories(directory, root, ignore):
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.name != ".git":
+                        st = entry.stat(follow_symlinks=False)
+                        signature.append((entry.path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            continue
+    return hash(tuple(signature))
+
+
+class RepositoryWatcher:
+    """Watches repositories for anything that could change their result: HEAD, the index, refs and config in the git directory, and the worktree.
+    Uses inotify on Linux. Repositories it can't watch (other platforms, out of inotify watches, --poll) are polled instead."""
+
+    def __init__(self, root: str, ignore: list[str], poll_interval: float = WATCH_POLL_INTERVAL, use_inotify: bool = True):
+        self.root = root
+        self.ignore = ignore
+        self.poll_interval = poll_interval
+        self.watches: Dict[int, Set[Tuple[str, bool]]] = {} # Watch descriptor -> (repository, whether it's a worktree directory)
+        self.paths: Dict[int, str] = {} # Watch descriptor -> watched directory
+        self.polled: Dict[str, Union[int, None]] = {} # Repository -> signature
+        self.inotify: Union[Inotify, None] = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                logger.info("Polling every %gs, inotify is unavailable: %s", poll_interval, e)
+
+    def add(self, directory: str):
+        """Start watching a repository."""
+        if self.inotify is not None:
+            try:
+                self.add_inotify(directory)
+                return
+            except OSError as e:
+                # Most likely out of watches (fs.inotify.max_user_watches), the watches added so far are harmless
+                logger.warning("Polling [%s] instead of watching it: %s", directory, e)
+                self.remove(directory)
+        self.polled[directory] = get_watch_signature(directory, self.root, self.ignore)
+
+    def add_inotify(self, directory: str):
+        """Add the inotify watches of a repository."""
+        git_dirs = resolve_git_dir(directory)
+        if git_dirs is None:
+            return
+        git_dir, common_dir = git_dirs
+
+        # refs is watched recursively, branches with slashes and every remote live in subdirectories
+        git_paths = {git_dir, common_dir}
+        for path, _, _ in os.walk(os.path.join(common_dir, "refs")):
+            git_paths.add(path)
+        for path in git_paths:
+            self.add_watch(path, directory, False)
+        for path in iter_watch_directories(directory, self.root, self.ignore):
+            self.add_watch(path, directory, True)
+
+    def add_watch(self, path: str, directory: str, worktree: bool):
+        """Add a single directory watch for a repository."""
+        try:
+            wd = self.inotify.add_watch(path, INOTIFY_WATCH_MASK)
+        except FileNotFoundError:
+            return # Removed in the meantime
+        self.watches.setdefault(wd, set()).add((directory, worktree))
+        self.paths[wd] = path
+
+    def remove(self, directory: str):
+        """Stop watching a repository. Its inotify watches are left for the kernel to drop when the directories go away."""
+        self.polled.pop(directory, None)
+        for wd, owners in list(self.watches.items()):
+            owners -= {(directory, True), (directory, False)}
+            if not owners:
+                del self.watches[wd], self.paths[wd]
+
+    def read_changes(self, timeout: Union[float, None]) -> Set[str]:
+        """Wait for inotify events and get the repositories they belong to. Directories created in watched places get watched too."""
+        changed: Set[str] = set()
+        for wd, mask, name in self.inotify.read_events(timeout):
+            if mask & INOTIFY_Q_OVERFLOW:
+                logger.warning("Missed file events, rechecking every watched repository")
+                changed.update(directory for owners in self.watches.values() for directory, _ in owners)
+                continue
+            if mask & INOTIFY_IGNORED:
+                self.watches.pop(wd, None)
+                self.paths.pop(wd, None)
+                continue
+            # git takes a lock file and renames it over the real one, the rename is the change that matters
+            if name.endswith(".lock"):
+                continue
+
+            for directory, worktree in list(self.watches.get(wd, ())):
+                changed.add(directory)
+                if mask & INOTIFY_ISDIR and mask & (INOTIFY_CREATE | INOTIFY_MOVED_TO):
+                    self.add_created_directory(wd, name, directory, worktree)
+        return changed
+
+    def add_created_directory(self, wd: int, name: str, directory: str, worktree: bool):
+        """Watch a directory that appeared inside a watched one. (New worktree directories, refs/remotes/<new remote>)"""
+        parent = self.paths.get(wd)
+        if parent is None or name == ".git":
+            return
+        path = os.path.join(parent, name)
+        try:
+            if not worktree:
+                for subdirectory, _, _ in os.walk(path):
+                    self.add_watch(subdirectory, directory, False)
+            elif not is_ignored(os.path.relpath(path, self.root), name, self.ignore) and detect_repository(path) is None:
+                for subdirectory in iter_watch_directories(path, self.root, self.ignore):
+                    self.add_watch(subdirectory, directory, True)
+        except OSError as e:
+            logger.warning("Unable to watch [%s]: %s", path, e)
+
+    def poll(self) -> Set[str]:
+        """Get the polled repositories whose signature changed."""
+        changed = set()
+        for directory, signature in list(self.polled.items()):
+            current = get_watch_signature(directory, self.root, self.ignore)
+            if current != signature:
+                self.polled[directory] = current
+                changed.add(directory)
+        return changed
+
+    def wait(self) -> Set[str]:
+        """Block until at least one repository changed and return the changed ones.
+        Events are collected until things are quiet for a moment, so a checkout or a build triggers one recheck rather than hundreds."""
+        while True:
+            timeout = self.poll_interval if self.polled or self.inotify is None else None
+            if self.inotify is not None:
+                changed = self.read_changes(timeout)
+                while changed and (more := self.read_changes(WATCH_DEBOUNCE)):
+                    changed |= more
+            else:
+                time.sleep(timeout)
+                changed = set()
+            changed |= self.poll()
+            if changed:
+                return changed
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+def watch_repositories(checked: Dict[str, StaleResult], root: str, ignore: list[str], backend: str, jobs: int, options: CheckOptions, on_result: Callable[[StaleResult, Union[StaleResult, None]], None], poll_interval: float = WATCH_POLL_INTERVAL, use_inotify: bool = True):
+    """Recheck repositories whenever their watched files change, until interrupted. checked holds the latest result of every repository
+    and on_result is called with every result that differs from the last one, along with the last one."""
+    # git status refreshes the index when it can, which would be a change to the repository it just checked
+    os.environ["GIT_OPTIONAL_LOCKS"] = "0"
+    watcher = RepositoryWatcher(root, ignore, poll_interval, use_inotify)
+    try:
+        for directory, result in checked.items():
+            # A bare repository has no worktree, its result never changes
+            if result.state != REPO_STATE_BARE:
+                watcher.add(directory)
+        logger.info("Watching %i repositories (%i polled)", len(checked), len(watcher.polled))
+
+        while True:
+            changed = watcher.wait()
+            logger.debug("Rechecking %i changed repositories", len(changed))
+            found = set()
+            for result in iter_scan_directories(sorted(changed), jobs, False, backend, None, None, options):
+                found.add(result.directory)
+                previous = checked.get(result.directory)
+                checked[result.directory] = result
+                if previous is None or previous._replace(timings=None) != result._replace(timings=None):
+                    on_result(result, previous)
+            # Repositories that were deleted
+            for directory in changed - found:
+                logger.info("Directory is no longer a repository: [%s]", directory)
+                watcher.remove(directory)
+                checked.pop(directory, None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+#### Query Server ####
+
+def get_socket_path() -> str:
+    """Get the default path of the --serve socket, following the XDG base directory spec. (scripts/stale-repo-query has a copy)"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "stale-repo-checker")
+    return os.path.join(runtime_dir, "stale-repo-checker.sock")
+
+
+def find_result(results: Dict[str, StaleResult], path: str) -> Union[StaleResult, None]:
+    """Find the result of the repository containing path, the innermost one if repositories are nested. None if no checked repository contains it."""
+    for candidate in dict.fromkeys((os.path.normpath(path), os.path.realpath(path))):
+        while True:
+            result = results.get(candidate)
+            if result is not None:
+                return result
+            parent = os.path.dirname(candidate)
+            if parent == candidate:
+                break
+            candidate = parent
+    return None
+
+
+def list_stale_results(results: Dict[str, StaleResult], prefix: Union[str, None]) -> list[StaleResult]:
+    """Get the stale repositories at or below prefix (every one if None), sorted by directory."""
+    if prefix is not None:
+        prefix = os.path.normpath(prefix)
+    return sorted((result for directory, result in results.items() if result.stale and (
+        prefix is None or directory == prefix or directory.startswith(prefix.rstrip(os.sep) + os.sep)
+    )), key=lambda result: result.directory)
+
+
+def answer_query(results: Dict[str, StaleResult], request: dict) -> dict:
+    """Answer a single query. ({"query": "repo", "path": ...} or {"query": "stale", "prefix": ...})"""
+    query = request.get("query")
+    if query == "repo":
+        if not isinstance(request.get("path"), str):
+            return {"ok": False, "error": "'repo' queries need a path"}
+        result = find_result(results, request["path"])
+        return {"ok": True, "result": result_to_dict(result) if result is not None else None}
+    if query == "stale":
+        prefix = request.get("prefix")
+        if prefix is not None and not isinstance(prefix, str):
+            return {"ok": False, "error": "The prefix must be a string"}
+        return {"ok": True, "results": [result_to_dict(result) for result in list_stale_results(results, prefix)]}
+    return {"ok": False, "error": f"Unknown query: {query!r}"}
+
+
+def create_query_server(path: str, results: Dict[str, StaleResult]) -> socketserver.UnixStreamServer:
+    """Bind the Unix domain socket queries about results are answered on. Each line received is a JSON query, each line sent back its JSON answer.
+    results is read as it's being updated, every query works on a copy taken at once. (See serving)"""
+    import socket
+    import socketserver
+
+    class QueryHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while line := self.rfile.readline(QUERY_MAX_REQUEST):
+                try:
+                    request = json.loads(line)
+                    # Copying is a single operation under the GIL, the watcher replacing results can't be seen half done
+                    response = answer_query(dict(results), request) if isinstance(request, dict) else {"ok": False, "error": "Queries must be JSON objects"}
+                except ValueError as e:
+                    response = {"ok": False, "error": f"Invalid query: {e}"}
+                self.wfile.write(f"{json.dumps(response)}\n".encode())
+
+    # A socket left behind by a server that died is replaced, one that still answers isn't. Anything else at the path is left alone.
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise OSError("path exists and is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+                raise OSError("Another server is already listening")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path)
+
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    # Only the current user gets to connect, results list paths from their whole workspace
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, QueryHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    return server
+
+
+@contextmanager
+def serving(server: socketserver.UnixStreamServer) -> Iterator[None]:
+    """Answer queries on a server from create_query_server while the context is active. The socket is removed afterwards."""
+    thread = threading.Thread(target=server.serve_forever, name="stale-query-server", daemon=True)
+    thread.start()
+    logger.info("Answering queries on %s", server.server_address)
+    try:
+        yield
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(server.server_address):
+            os.unlink(server.server_address)
+
+
+#### Profiling ####
+
+class StackSampler:
+    """Samples the Python stack of every other thread at a fixed interval and counts identical stacks, giving collapsed stacks for flamegraph.pl or speedscope."""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stale-profile", daemon=True)
+
+    def run(self):
+        """Take samples until stopped."""
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    # Semicolons separate the frames in the collapsed format, spaces separate the count
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":").replace(" ", "_"))
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write_collapsed(self, path: str):
+        """Write the samples in the collapsed stack format, one `frame;frame;frame count` line per distinct stack."""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profiling(path: Union[str, None]) -> Iterator[None]:
+    """Profile the block with cProfile and sample its stacks, writing the pstats to path and the collapsed stacks to path.collapsed. Does nothing without a path."""
+    if path is None:
+        yield
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(path)
+        sampler.write_collapsed(f"{path}.collapsed")
+        logger.info("Wrote the profile to [%s] and its collapsed stacks to [%s.collapsed]", path, path)
 
 
 #### Output Helpers ####
 
-def output_repo(args: argparse.Namespace, result: StaleResult, diff: int):
-    """Output the name of the repository and the number of commits ahead/behind the remote. Automatically handles colorization."""
-    diff_sign = "+" if diff > 0 else "-"
+def format_repo(args: argparse.Namespace, result: StaleResult) -> str:
+    """Format the name of the repository and the number of commits ahead/behind the remote. Automatically handles colorization."""
+    # Diverged branches show both counts, otherwise just the side that differs
+    counts = []
+    if result.ahead:
+        counts.append((f"+{result.ahead}", COLOR_AHEAD))
+    if result.behind or not result.ahead:
+        counts.append((f"-{result.behind}", COLOR_BEHIND))
 
     if args.colorize:
-        color_diff = Fore.LIGHTGREEN_EX if diff > 0 else Fore.LIGHTRED_EX
+        diff = " ".join(f"{color_diff}{count}{Style.RESET_ALL}" for count, color_diff in counts)
 
-        print(f"{COLOR_REPO}{STYLE_REPO}{result.directory}{Style.RESET_ALL} [{color_diff}{diff_sign}{abs(diff)}{Style.RESET_ALL}]{Style.RESET_ALL}")
+        return f"{COLOR_REPO}{STYLE_REPO}{result.directory}{Style.RESET_ALL} [{diff}]{Style.RESET_ALL}\n"
     else:
-        print(f"{result.directory} [{diff_sign}{abs(diff)}]")
+        diff = " ".join(count for count, _ in counts)
+        return f"{result.directory} [{diff}]\n"
 
-def output_status(args: argparse.Namespace, status: str):
-    """Output the status of the repository. Automatically handles colorization."""
+def format_status(args: argparse.Namespace, status: str) -> str:
+    """Format the status of the repository. Automatically handles colorization."""
     if not args.status:
-        return
+        return ""
 
     status = status.strip()
     if args.colorize:
         status = f"{COLOR_STATUS}{STYLE_STATUS}{status}{Style.RESET_ALL}"
 
-    status = insert_indentation(status, args.indent)
-
-    print(status)
-
-
-def output_files(args: argparse.Namespace, files: RepoFiles):
-    """Output the modified and untracked files lists. Automatically handles colorization."""
-    if not args.status:
-        return
+    return insert_indentation(status, args.indent) + "\n"
+
+
+def format_files(args: argparse.Namespace, files: RepoFiles) -> str:
+    """Format the modified and untracked files lists. Automatically handles colorization."""
+    if not args.status or not args.list_files:
+        return ""
+    if len(files.modified) == 0 and len(files.untracked) == 0:
+        return ""
+
+    def format_files(files: PathList, color: str=COLOR_FILE, style: str=STYLE_FILE) -> str:
+        # The indentation and color codes are the same for every name, so build them once and join the whole list in one go
+        prefix = args.indent * 2
+        suffix = "\n"
+        if args.colorize:
+            prefix = f"{prefix}{color}{style}"
+            suffix = f"{Style.RESET_ALL}\n"
+        separator = suffix + prefix
+        # Names containing newlines (rare, but legal) still get each line indented
+        return prefix + separator.join(name.replace("\n", f"\n{args.indent * 2}") for name in files) + suffix
+
+    def format_remaining(listed: PathList, count: int) -> str:
+        if count <= len(listed):
+            return ""
+        return insert_indentation(f"... and {count - len(listed)} more", args.indent, 2) + "\n"
+
+    parts = []
+    if len(files.modified) > 0:
+        parts.append(insert_indentation("Modified:", args.indent) + "\n")
+        parts.append(format_files(files.modified, COLOR_MODIFIED, STYLE_MODIFIED))
+        parts.append(format_remaining(files.modified, files.modified_count))
+
+    if len(files.untracked) > 0:
+        parts.append(format_blank(args))
+        parts.append(insert_indentation("Untracked:", args.indent) + "\n")
+        parts.append(format_files(files.untracked, COLOR_UNTRACKED, STYLE_UNTRACKED))
+        parts.append(format_remaining(files.untracked, files.untracked_count))
+
+    return "".join(parts)
+
+
+def format_branches(args: argparse.Namespace, branches: list[BranchStatus]) -> str:
+    """Format the out of sync branches found by --all-branches. Automatically handles colorization."""
+    if not args.status or not branches:
+        return ""
+
+    lines = [insert_indentation("Branches:", args.indent)]
+    for branch in branches:
+        if branch.state == REPO_STATE_NO_UPSTREAM:
+            detail = "no upstream"
+        elif branch.state == REPO_STATE_UPSTREAM_GONE:
+            detail = f"{branch.upstream} is gone"
+        else:
+            counts = " ".join(count for count, value in ((f"+{branch.ahead}", branch.ahead), (f"-{branch.behind}", branch.behind)) if value)
+            detail = f"{counts} {branch.upstream}"
+
+        name = f"{COLOR_BRANCH}{STYLE_BRANCH}{branch.name}{Style.RESET_ALL}" if args.colorize else branch.name
+        lines.append(insert_indentation(f"{name} [{detail}]", args.indent, 2))
+    return "\n".join(lines) + "\n"
+
+
+def format_blank(args: argparse.Namespace) -> str:
+    """Format a newline to separate the output of multiple repositories. Resets colorization if enabled."""
+    if args.colorize:
+        return f"{Style.RESET_ALL}\n"
+    return "\n"
 
-    if args.list_files:
-        if len(files.modified) == 0 and len(files.untracked) == 0:
-            return
 
-        def output_files(files: list[str], color: str=COLOR_FILE, style: str=STYLE_FILE):
-            text = ""
-            for name in files:
-                if args.colorize:
-                    text = f"{color}{style}{name}{Style.RESET_ALL}"
-                    # TODO: Instead of checking the arg for each output function, create a "get_colorize" function that will return the correct codes or nothing based on that argument.
-                    # i.e. text = f"{get_colorize(args.colorize, "MODIFIED")}{name}{get_colorize()}
-                else:
-                    text = name
+def output_repo(args: argparse.Namespace, result: StaleResult):
+    """Output the name of the repository and the number of commits ahead/behind the remote. (See format_repo)"""
+    sys.stdout.write(format_repo(args, result))
 
-                text = insert_indentation(text, args.indent, 2)
-                print(text)
 
-        if len(files.modified) > 0:
-            print(insert_indentation("Modified:", args.indent))
-            output_files(files.modified, COLOR_MODIFIED, STYLE_MODIFIED)
+def output_result(args: argparse.Namespace, result: StaleResult):
+    """Output everything reported for a stale repository."""
+    # The whole block is written at once. Every write goes through colorama's conversion, so one big write is far cheaper than a print per line.
+    sys.stdout.write("".join((
+        format_repo(args, result),
+        format_status(args, result.status_message),
+        format_branches(args, result.branches),
+        format_files(args, result.files),
+        format_blank(args),
+    )))
 
-        if len(files.untracked) > 0:
-            output_blank(args)
-            print(insert_indentation("Untracked:", args.indent))
-            output_files(files.untracked, COLOR_UNTRACKED, STYLE_UNTRACKED)
 
+def format_timings(args: argparse.Namespace, results: list[StaleResult], elapsed: float) -> str:
+    """Format the --timings report: the slowest repositories with their phases, then the time spent per phase across all of them."""
+    def format_phases(timings: Dict[str, float]) -> str:
+        # Known phases first in a fixed order, anything else after them
+        phases = [phase for phase in TIMING_PHASES if phase in timings] + sorted(set(timings) - set(TIMING_PHASES) - {"total"})
+        return ", ".join(f"{phase} {timings[phase]:.3f}s" for phase in phases)
 
-def output_blank(args: argparse.Namespace):
-    """Output a newline to separate the output of multiple repositories. Resets colorization if enabled."""
-    if args.colorize:
-        print(f"{Style.RESET_ALL}")
-    else:
-        print("")
+    totals: Dict[str, float] = {}
+    for result in results:
+        for phase, seconds in result.timings.items():
+            totals[phase] = totals.get(phase, 0.0) + seconds
+
+    slowest = sorted(results, key=lambda result: result.timings.get("total", 0.0), reverse=True)[:args.timings]
+    lines = [f"Timings for {len(results)} repositories ({elapsed:.3f}s elapsed, {totals.get('total', 0.0):.3f}s spent checking):"]
+    lines.append(insert_indentation(f"{len(slowest)} slowest:", args.indent))
+    for result in slowest:
+        lines.append(insert_indentation(f"{result.timings.get('total', 0.0):.3f}s {result.directory} ({format_phases(result.timings)})", args.indent, 2))
+    lines.append(insert_indentation("Per phase:", args.indent))
+    lines.append(insert_indentation(format_phases(totals).replace(", ", "\n"), args.indent, 2))
+    return "\n".join(lines) + "\n"
+
+
+class JsonOutput:
+    """Writes results as they arrive, either as a JSON array (one element per line) or as newline delimited JSON."""
+
+    def __init__(self, ndjson: bool, stream: Union[TextIO, None] = None):
+        self.ndjson = ndjson
+        self.stream = stream or sys.stdout
+        self.count = 0
+
+    def write(self, result: StaleResult):
+        """Write a single result."""
+        line = json.dumps(result_to_dict(result))
+        if self.ndjson:
+            self.stream.write(f"{line}\n")
+        else:
+            self.stream.write(f"{'[' if self.count == 0 else ','}\n{line}")
+        self.count += 1
+
+    def close(self):
+        """Finish the output. (Closes the JSON array)"""
+        if not self.ndjson:
+            self.stream.write("[\n]\n" if self.count == 0 else "\n]\n")
+        self.stream.flush()
 
 
 #### Main ####
@@ -260,47 +2346,129 @@ def output_blank(args: argparse.Namespace):
 def main(args):
     """Check if the passed root directory or any of it's subdirectories contains a git repository with uncommitted changes."""
     setup_logging(args.verbose)
+    if args.colorize:
+        setup_colors()
     root_directory = args.root
     logger.info("Checking root directory: %s", args.root)
 
-    # First check if the supplied directory is a git repository itself. If it is, assume this is the only directory to check.
-    result = check_directory(root_directory)
+    # If the supplied directory is a git repository itself, assume this is the only directory to check (unless looking for nested repos).
+    ignore = DEFAULT_IGNORE + (args.ignore or [])
+    stats = ScanStats()
+    cache = None if args.no_cache else ScanCache(get_cache_path()).load()
 
-    max_depth = args.depth
-    walked_depth = 0
+    # Machine readable output includes every repository, the text report only the stale ones
+    json_output = JsonOutput(args.format == "ndjson") if args.format != "text" else None
 
+    # When streaming results are also printed as soon as each repository is done
     results: list[StaleResult] = []
+    timed_results: list[StaleResult] = [] # Every repository, stale or not, for the --timings report
+    fetch_times: Dict[str, float] = {}
+    checked: Dict[str, StaleResult] = {} # Every repository, for --watch to compare rechecks against
+    def collect(result: StaleResult):
+        if args.watch:
+            checked[result.directory] = result
+        if args.timings is not None:
+            if result.directory in fetch_times:
+                result = add_timing(result, "fetch", fetch_times[result.directory])
+            timed_results.append(result)
+        if json_output is None and not result.stale:
+            return
+        if args.stream:
+            if json_output is not None:
+                json_output.write(result)
+            else:
+                output_result(args, result)
+            sys.stdout.flush()
+        results.append(result)
+
+    # Bound before scanning, so a server that's already running is found out right away
+    server = None
+    if args.serve is not None:
+        try:
+            server = create_query_server(args.serve, checked)
+        except OSError as e:
+            logger.error("Unable to listen on [%s]: %s", args.serve, e)
+            sys.exit(1)
+
+    # Machine readable output always carries the file lists, the text report only when asked to list them
+    options = CheckOptions(args.list_files or json_output is not None, args.untracked, args.max_files, args.all_branches, args.timings is not None, args.profile is not None)
+    start = time.perf_counter()
+    with profiling(args.profile):
+        if args.fetch:
+            # Everything has to be discovered up front so the remotes are fetched before any repository is compared against them
+            directories = [directory for directory in discover_directories(root_directory, args.depth, ignore, args.nested) if detect_repository(directory) is not None]
+            for fetched in fetch_repositories(directories, args.fetch_jobs or args.jobs, args.fetch_timeout, stats):
+                fetch_times[fetched.directory] = fetched.duration
+            logger.info("Fetched %i repositories, %i failed", stats.fetched, stats.fetch_failed)
+
+        if args.use_async:
+            import asyncio
+            asyncio.run(scan_root_async(root_directory, args.depth, ignore, args.nested, args.jobs, stats, cache, collect, options))
+        else:
+            directories = iter_discover_directories(root_directory, args.depth, ignore, args.nested)
+            for result in iter_scan_directories(directories, args.jobs, args.processes, args.backend, stats, cache, options):
+                collect(result)
+    logger.info("Skipped %i of %i candidate directories that aren't repositories", stats.skipped, stats.candidates)
+    logger.info("Reused %i cached results", stats.cached)
+    elapsed = time.perf_counter() - start
+
+    if cache is not None:
+        try:
+            cache.save(root_directory)
+        except OSError as e:
+            logger.warning("Unable to write scan cache [%s]: %s", cache.path, e)
+
+    # The report goes to stderr so it never gets mixed into machine readable output
+    if args.timings is not None:
+        sys.stderr.write(format_timings(args, timed_results, elapsed))
+
+    # Async checks need an event loop per recheck, the porcelain backend runs the same `git status` synchronously
+    backend = "porcelain" if args.use_async else args.backend
+    if server is not None:
+        # The results are only answered over the socket, kept current by watching the repositories
+        def log_update(result: StaleResult, previous: Union[StaleResult, None]):
+            logger.info("Updated [%s]: %s", result.directory, "stale" if result.stale else "not stale")
+        with serving(server):
+            watch_repositories(checked, root_directory, ignore, backend, args.jobs, options, log_update, args.poll_interval, not args.poll)
+        return
 
-    # Glob the root directory for directories
-    for subdir, dirs, files in os.walk(root_directory):
-        walked_depth += 1
+    output_results(args, results, json_output)
 
-        for directory in dirs:
-            full_path = os.path.join(subdir, directory)
-            result = check_directory(full_path)
-            
-            results.append(result)
+    if args.watch:
+        def update(result: StaleResult, previous: Union[StaleResult, None]):
+            if json_output is not None:
+                json_output.write(result)
+            elif result.stale:
+                output_result(args, result)
+            elif previous is not None and previous.stale:
+                output_result(args, result._replace(status_message="No longer stale.", branches=(), files=RepoFiles()))
+            sys.stdout.flush()
+        watch_repositories(checked, root_directory, ignore, backend, args.jobs, options, update, args.poll_interval, not args.poll)
 
-        if walked_depth >= max_depth:
-            break
 
-    # Remove any directories that aren't stale
-    results = [result for result in results if result.stale]
-    # Then sort and print results
+def output_results(args: argparse.Namespace, results: list[StaleResult], json_output: Union[JsonOutput, None]):
+    """Sort and print the results of a scan, whatever wasn't already streamed."""
     results.sort(key=lambda x: x[0])
-    for result in results:
-        if not result.stale:
-            continue
+    if json_output is not None:
+        if not args.stream:
+            for result in results:
+                json_output.write(result)
+        json_output.close()
+        return
+
+    if args.stream and not args.summary:
+        return
 
-        status = get_repo_status(Repo(result.directory))
-        diff = get_repo_commit_diff(Repo(result.directory))
-        color_diff = Fore.LIGHTGREEN_EX if diff > 0 else Fore.LIGHTRED_EX
-        diff_sign = "+" if diff > 0 else "-"
+    if args.stream:
+        # Everything was already printed, the summary is just the sorted list of stale repositories
+        print(f"{len(results)} stale repositories:")
+        for result in results:
+            output_repo(args, result)
+        return
 
-        output_repo(args, result, diff)
-        output_status(args, status)
-        output_files(args, result.files)
-        output_blank(args)
+    for result in results:
+        output_result(args, result)
+    sys.stdout.flush()
 
 
 ##############################################################################
@@ -308,16 +2476,39 @@ def main(args):
 
 #### Startup ####
 
-if __name__ == "__main__":
+def parse_args(argv: Union[list[str], None] = None) -> argparse.Namespace:
+    """Parse and validate the command line. Only the light modules are imported by now, so --help and bad arguments return quickly."""
     parser = argparse.ArgumentParser()
     parser.add_argument("root", help="Root directory to check")
     parser.add_argument("-v", "--verbose", help="increase output verbosity", action="count", default=0)
     parser.add_argument("-d", "--depth", help="Depth of tree to check for stale directories. 1-99", type=int, default=1)
     parser.add_argument("-l", "--list", help="List untracked/modified files", action="store_true", dest="list_files")
+    parser.add_argument("-u", "--untracked", help="How untracked files are found. 'normal' (like git status) collapses untracked directories, 'no' skips them.", choices=UNTRACKED_MODES, default="normal")
+    parser.add_argument("-m", "--max-files", help="Maximum number of modified/untracked files listed per repository", type=int, metavar="N")
+    parser.add_argument("-a", "--all-branches", help="Report every local branch that is ahead of, behind or missing its upstream, not just the active one", action="store_true")
     parser.add_argument("-c", "--color", help="Colorize output", action="store_true", dest="colorize")
     parser.add_argument("-S", "--no-status", help="Don't show status", action="store_false", dest="status")
     parser.add_argument("-i", "--indent", help="String to insert per level of indentation.", type=str, default="\t")
-    args = parser.parse_args()
+    parser.add_argument("-I", "--ignore", help="Glob of directory names/paths (relative to root) to skip. Can be repeated.", action="append", metavar="GLOB")
+    parser.add_argument("-n", "--nested", help="Keep descending into repositories to find nested repos/submodules", action="store_true")
+    parser.add_argument("-j", "--jobs", help="Number of directories to check concurrently. Defaults to the CPU count.", type=int, default=get_default_jobs())
+    parser.add_argument("--processes", help="Check directories in worker processes instead of threads", action="store_true")
+    parser.add_argument("-F", "--fetch", help="Fetch the tracked remote of every repository before checking them", action="store_true")
+    parser.add_argument("--fetch-jobs", help="Number of concurrent fetches. Defaults to --jobs.", type=int, metavar="N")
+    parser.add_argument("--fetch-timeout", help="Seconds before a single fetch is abandoned", type=float, default=60, metavar="SECONDS")
+    parser.add_argument("--async", help="Check repositories with asyncio subprocesses, --jobs limits the git processes in flight. (Implies the porcelain backend)", action="store_true", dest="use_async")
+    parser.add_argument("-f", "--format", help="Output format. json and ndjson include every repository found, not just the stale ones.", choices=["text", "json", "ndjson"], default="text")
+    parser.add_argument("-s", "--stream", help="Print stale repositories as soon as they're checked instead of sorted at the end", action="store_true")
+    parser.add_argument("--summary", help="With --stream, finish with a sorted list of the stale repositories", action="store_true")
+    parser.add_argument("--timings", help=f"Time each phase of every check and report the N slowest repositories and the totals per phase on stderr. (Default {DEFAULT_TIMINGS_COUNT}) JSON output includes each repository's timings.", type=int, nargs="?", const=DEFAULT_TIMINGS_COUNT, metavar="N")
+    parser.add_argument("--profile", help="Profile the scan with cProfile, writing the stats to PATH and collapsed stacks (for flamegraphs) to PATH.collapsed. Checks run one at a time and the --timings report splits each into Python and git CPU time.", metavar="PATH")
+    parser.add_argument("-w", "--watch", help="Keep running after the scan, rechecking repositories as their files change and printing whatever changed. (Uses inotify where available)", action="store_true")
+    parser.add_argument("--poll", help="With --watch, poll repositories for changes instead of using inotify", action="store_true")
+    parser.add_argument("--poll-interval", help=f"Seconds between polls of repositories that aren't watched with inotify. (Default {WATCH_POLL_INTERVAL:g})", type=float, default=WATCH_POLL_INTERVAL, metavar="SECONDS")
+    parser.add_argument("--serve", help=f"Keep the results in memory after the scan, watching the repositories like --watch, and answer JSON queries on a Unix domain socket instead of printing them. (Default {get_socket_path()}, see scripts/stale-repo-query)", nargs="?", const="", metavar="SOCKET")
+    parser.add_argument("--no-cache", help="Don't reuse or record results of previous scans", action="store_true")
+    parser.add_argument("-b", "--backend", help="How repositories are inspected. 'porcelain' runs a single `git status` per repo, 'native' reads .git directly and only uses GitPython for stale repos.", choices=BACKENDS.keys(), default="gitpython")
+    args = parser.parse_args(argv)
 
     # Validation???
     if 1 > args.depth > 99: # (depth < 1 or depth > 99) Python's chained comparison is cool!
@@ -326,5 +2517,48 @@ if __name__ == "__main__":
     else:
         args.depth = max(min(args.depth, 99), 1) # constrain to 1-99
 
+    if args.max_files is not None and args.max_files < 0:
+        logger.warning("Max files '%i' can't be negative. Listing every file!", args.max_files)
+        args.max_files = None
 
-    main(args)
+    if args.timings is not None and args.timings < 0:
+        logger.warning("Timings '%i' can't be negative. Defaulting to %i!", args.timings, DEFAULT_TIMINGS_COUNT)
+        args.timings = DEFAULT_TIMINGS_COUNT
+
+    if args.jobs < 1:
+        logger.warning("Jobs '%i' must be at least 1. Defaulting to 1!", args.jobs)
+        args.jobs = 1
+
+    if args.poll_interval <= 0:
+        logger.warning("Poll interval '%g' must be positive. Defaulting to %g!", args.poll_interval, WATCH_POLL_INTERVAL)
+        args.poll_interval = WATCH_POLL_INTERVAL
+
+    # Queries ask about absolute paths, and the results are only written to the socket
+    if args.serve is not None:
+        args.serve = args.serve or get_socket_path()
+        args.root = os.path.abspath(args.root)
+        args.watch, args.stream, args.format = True, False, "text"
+
+    # A JSON array can't be finished while results keep coming
+    if args.watch and args.format == "json":
+        logger.warning("JSON output can't be watched, writing ndjson instead!")
+        args.format = "ndjson"
+
+    # cProfile only sees the main thread, and the CPU time attribution needs one check at a time
+    if args.profile is not None:
+        if args.use_async:
+            args.use_async, args.backend = False, "porcelain"
+        args.jobs, args.processes = 1, False
+        if args.timings is None:
+            args.timings = DEFAULT_TIMINGS_COUNT
+
+    return args
+
+
+def run(argv: Union[list[str], None] = None) -> None:
+    """Entry point, for launchers that import this module so its bytecode is cached instead of compiled on every run."""
+    main(parse_args(argv))
+
+
+if __name__ == "__main__":
+    run()
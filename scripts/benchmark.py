@@ -0,0 +1,366 @@
+#!/bin/env python3
+
+"""
+    Stale Directory Checker benchmark
+
+    Builds a synthetic farm of git repositories (no network needed) and times discovery and checking,
+    per backend and per phase, plus the whole script end to end and its startup time.
+
+    Usage:
+        python scripts/benchmark.py --repos 200 --depth 2 --dirty 0.2 --diverged 0.1
+        python scripts/benchmark.py --farm /tmp/farm --keep    (build once, then reuse with --farm /tmp/farm)
+        python scripts/benchmark.py --startup-only
+
+"""
+
+
+##############################################################################
+
+### Imports ###
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Union
+
+# main.py lives in the repository root
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+
+import main as checker
+
+
+#### Constants ####
+
+# Fixed identity and dates so every farm built with the same seed is identical
+FARM_ENV = {
+    "GIT_AUTHOR_NAME": "Benchmark",
+    "GIT_AUTHOR_EMAIL": "benchmark@example.com",
+    "GIT_AUTHOR_DATE": "2023-01-11T00:00:00Z",
+    "GIT_COMMITTER_NAME": "Benchmark",
+    "GIT_COMMITTER_EMAIL": "benchmark@example.com",
+    "GIT_COMMITTER_DATE": "2023-01-11T00:00:00Z",
+    "GIT_CONFIG_NOSYSTEM": "1",
+}
+
+# Marks a directory as a farm built by this script, so --farm never reuses (or --keep never leaves) anything else
+FARM_MARKER = ".stale-benchmark.json"
+
+# Number of group directories per level, repositories are spread across them
+FARM_FANOUT = 4
+
+MAIN_SCRIPT = os.path.join(ROOT_DIRECTORY, "main.py")
+LAUNCHER_SCRIPT = os.path.join(ROOT_DIRECTORY, "scripts", "stale-repo-checker")
+
+
+#### Farm ####
+
+def run_git(*args: str, cwd: Union[str, None] = None) -> None:
+    """Run a git command for building the farm, failing loudly."""
+    subprocess.run(["git", *args], cwd=cwd, env=dict(os.environ, **FARM_ENV), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def commit_file(repo: str, name: str, content: str) -> None:
+    """Write a file and commit it."""
+    with open(os.path.join(repo, name), "w", encoding="utf-8") as f:
+        f.write(content)
+    run_git("add", name, cwd=repo)
+    run_git("commit", "--quiet", "-m", f"Update {name}", cwd=repo)
+
+
+def build_template(root: str, commits: int, files: int) -> str:
+    """Build the bare repository every farm repository is cloned from."""
+    work = os.path.join(root, "template")
+    run_git("init", "--quiet", "--initial-branch=main", work)
+    for index in range(files):
+        with open(os.path.join(work, f"file{index}.txt"), "w", encoding="utf-8") as f:
+            f.write(f"{index}\n")
+    run_git("add", ".", cwd=work)
+    run_git("commit", "--quiet", "-m", "Initial commit", cwd=work)
+    for index in range(1, commits):
+        commit_file(work, f"file{index % files}.txt", f"revision {index}\n")
+
+    template = os.path.join(root, "template.git")
+    run_git("clone", "--quiet", "--bare", work, template)
+    shutil.rmtree(work)
+    return template
+
+
+def get_repo_path(root: str, index: int, depth: int) -> str:
+    """Get where the index'th repository goes, spread over depth - 1 levels of group directories."""
+    parts = [root]
+    value = index
+    for level in range(depth - 1):
+        parts.append(f"group{level}-{value % FARM_FANOUT}")
+        value //= FARM_FANOUT
+    parts.append(f"repo{index:05}")
+    return os.path.join(*parts)
+
+
+def build_farm(root: str, args: argparse.Namespace) -> Dict[str, int]:
+    """Build the synthetic repositories under root. Returns how many of each kind were made."""
+    rng = random.Random(args.seed)
+    os.makedirs(root, exist_ok=True)
+    template = build_template(root, max(args.commits, 2), args.files)
+    scan_root = os.path.join(root, "scan")
+    counts = {"repos": 0, "dirty": 0, "untracked": 0, "ahead": 0, "behind": 0, "diverged": 0}
+
+    for index in range(args.repos):
+        path = get_repo_path(scan_root, index, args.depth)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Either every repository gets its own bare remote, or they all share the template
+        remote = template
+        if args.bare_remotes:
+            remote = os.path.join(root, "remotes", f"repo{index:05}.git")
+            run_git("clone", "--quiet", "--bare", "--local", template, remote)
+        run_git("clone", "--quiet", "--local", remote, path)
+        counts["repos"] += 1
+
+        # Out of sync branches. Behind is faked by moving the branch back, so the remote never changes.
+        kind = rng.random()
+        if kind < args.diverged:
+            run_git("reset", "--quiet", "--hard", "HEAD~1", cwd=path)
+            commit_file(path, "local.txt", "diverged\n")
+            counts["diverged"] += 1
+        elif kind < args.diverged + args.ahead:
+            commit_file(path, "local.txt", "ahead\n")
+            counts["ahead"] += 1
+        elif kind < args.diverged + args.ahead + args.behind:
+            run_git("reset", "--quiet", "--hard", "HEAD~1", cwd=path)
+            counts["behind"] += 1
+
+        if rng.random() < args.dirty:
+            with open(os.path.join(path, "file0.txt"), "a", encoding="utf-8") as f:
+                f.write("dirty\n")
+            counts["dirty"] += 1
+
+        if args.untracked and rng.random() < args.untracked_ratio:
+            untracked = os.path.join(path, "untracked")
+            os.makedirs(untracked, exist_ok=True)
+            for number in range(args.untracked):
+                with open(os.path.join(untracked, f"new{number}.txt"), "w", encoding="utf-8") as f:
+                    f.write(f"{number}\n")
+            counts["untracked"] += 1
+
+    with open(os.path.join(root, FARM_MARKER), "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "counts": counts}, f)
+    return counts
+
+
+def load_farm(root: str) -> Union[dict, None]:
+    """Load the description of a farm built earlier, None if root isn't one."""
+    try:
+        with open(os.path.join(root, FARM_MARKER), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+#### Timing ####
+
+def time_runs(func: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """Time repeated calls of func. Returns the fastest, the median and the slowest wall time in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "max": max(times)}
+
+
+def sum_phases(results: list) -> Dict[str, float]:
+    """Add up the phase timings of checked repositories."""
+    totals: Dict[str, float] = {}
+    for result in results:
+        for phase, seconds in result.timings.items():
+            totals[phase] = totals.get(phase, 0.0) + seconds
+    return totals
+
+
+def run_benchmarks(scan_root: str, args: argparse.Namespace) -> Dict[str, dict]:
+    """Time discovery, checking with each backend and the script end to end."""
+    benchmarks: Dict[str, dict] = {}
+    ignore = checker.DEFAULT_IGNORE
+
+    benchmarks["discovery"] = time_runs(lambda: checker.discover_directories(scan_root, args.depth, ignore), args.repeat)
+    directories = [directory for directory in checker.discover_directories(scan_root, args.depth, ignore) if checker.detect_repository(directory) is not None]
+
+    options = checker.CheckOptions(args.list_files, "normal", None, args.all_branches)
+    timed_options = options._replace(timings=True)
+    for backend in args.backends:
+        name = f"check[{backend}]"
+        benchmarks[name] = time_runs(lambda: checker.scan_directories(directories, args.jobs, False, backend, None, None, options), args.repeat)
+        # One more run with timings on for the per phase breakdown, kept out of the wall times above
+        benchmarks[name]["phases"] = sum_phases(checker.scan_directories(directories, args.jobs, False, backend, None, None, timed_options))
+
+    benchmarks["check[async]"] = time_runs(lambda: asyncio.run(checker.scan_root_async(scan_root, args.depth, ignore, False, args.jobs, checker.ScanStats(), None, None, options)), args.repeat)
+
+    # Everything a user waits for: interpreter startup, imports, discovery, checking and output
+    command = [sys.executable, MAIN_SCRIPT, scan_root, "-d", str(args.depth), "-j", str(args.jobs), "--no-cache"]
+    if args.list_files:
+        command.append("-l")
+    if args.all_branches:
+        command.append("-a")
+    benchmarks["end-to-end"] = time_runs(lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL), args.repeat)
+    return benchmarks
+
+
+def measure_result_memory(directories: list[str], backend: str, args: argparse.Namespace) -> Dict[str, float]:
+    """Measure the memory held by the results of a scan listing every file. Returns the bytes retained, per result and per listed file."""
+    options = checker.CheckOptions(True, "all", None, args.all_branches)
+    # Warm up first so lazy imports and caches (git config, GitPython) aren't counted. One job, so no thread pool allocations either.
+    checker.scan_directories(directories, 1, False, backend, None, None, options)
+    gc.collect()
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        results = checker.scan_directories(directories, 1, False, backend, None, None, options)
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    files = sum(len(result.files.modified) + len(result.files.untracked) for result in results)
+    return {"bytes": retained, "results": len(results), "files": files, "per_result": retained / max(len(results), 1), "per_file": retained / files if files else 0.0}
+
+
+def run_memory_benchmarks(scan_root: str, args: argparse.Namespace) -> Dict[str, dict]:
+    """Measure the memory held by scan results with each backend."""
+    directories = [directory for directory in checker.discover_directories(scan_root, args.depth, checker.DEFAULT_IGNORE) if checker.detect_repository(directory) is not None]
+    return {f"memory[{backend}]": measure_result_memory(directories, backend, args) for backend in args.backends}
+
+
+def run_startup_benchmarks(args: argparse.Namespace) -> Dict[str, dict]:
+    """Time how long the checker takes to start and exit when there's nothing to check, run as a script and through the launcher."""
+    def run(*command: str) -> Callable[[], object]:
+        return lambda: subprocess.run([sys.executable, *command], check=True, cwd=ROOT_DIRECTORY, stdout=subprocess.DEVNULL)
+
+    benchmarks: Dict[str, dict] = {}
+    empty = tempfile.mkdtemp(prefix="stale-benchmark-empty-")
+    try:
+        # The interpreter on its own, everything above it is the checker's
+        benchmarks["startup[python]"] = time_runs(run("-c", "pass"), args.startup_repeat)
+        benchmarks["startup[import]"] = time_runs(run("-c", "import main"), args.startup_repeat)
+        benchmarks["startup[--help]"] = time_runs(run(MAIN_SCRIPT, "--help"), args.startup_repeat)
+        benchmarks["startup[empty]"] = time_runs(run(MAIN_SCRIPT, empty, "--no-cache"), args.startup_repeat)
+        benchmarks["startup[launcher]"] = time_runs(run(LAUNCHER_SCRIPT, empty, "--no-cache"), args.startup_repeat)
+    finally:
+        os.rmdir(empty)
+    return benchmarks
+
+
+#### Output ####
+
+def format_report(farm: Union[dict, None], benchmarks: Dict[str, dict], memory: Union[Dict[str, dict], None] = None) -> str:
+    """Format the benchmark results as a plain text table."""
+    lines = []
+    if farm is not None:
+        counts = ", ".join(f"{count} {kind}" for kind, count in farm["counts"].items())
+        lines += [f"Farm: {counts}", ""]
+    lines.append(f"{'benchmark':<20} {'min':>9} {'median':>9} {'max':>9}")
+    for name, result in benchmarks.items():
+        lines.append(f"{name:<20} {result['min']:>8.3f}s {result['median']:>8.3f}s {result['max']:>8.3f}s")
+        for phase, seconds in result.get("phases", {}).items():
+            if phase != "total":
+                lines.append(f"    {phase:<16} {seconds:>8.3f}s")
+
+    if memory:
+        lines += ["", f"{'memory':<20} {'retained':>10} {'per result':>11} {'per file':>9}"]
+        for name, result in memory.items():
+            lines.append(f"{name:<20} {result['bytes'] / 1024:>6.0f} KiB {result['per_result']:>9.0f} B {result['per_file']:>7.1f} B")
+    return "\n".join(lines)
+
+
+#### Main ####
+
+def main(args: argparse.Namespace) -> None:
+    """Build (or reuse) a farm, benchmark it and report."""
+    if args.startup_only:
+        benchmarks = run_startup_benchmarks(args)
+        print(json.dumps({"benchmarks": benchmarks}, indent=2) if args.json else format_report(None, benchmarks))
+        return
+
+    root = args.farm or tempfile.mkdtemp(prefix="stale-benchmark-")
+    farm = load_farm(root)
+    built = farm is None
+    if built:
+        if os.path.exists(root) and os.listdir(root):
+            sys.exit(f"Refusing to build a farm in [{root}], it isn't empty")
+        print(f"Building {args.repos} repositories in [{root}]...", file=sys.stderr)
+        start = time.perf_counter()
+        try:
+            farm = {"args": vars(args), "counts": build_farm(root, args)}
+        except BaseException:
+            shutil.rmtree(root, ignore_errors=True) # Never leave a half built farm behind for --farm to trip over
+            raise
+        print(f"Built in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    else:
+        # The layout has to match what was built, everything else (jobs, repeat, backends) can change between runs
+        args.depth = farm["args"]["depth"]
+        print(f"Reusing the farm in [{root}]", file=sys.stderr)
+
+    try:
+        benchmarks = run_benchmarks(os.path.join(root, "scan"), args)
+        benchmarks.update(run_startup_benchmarks(args))
+        memory = run_memory_benchmarks(os.path.join(root, "scan"), args)
+    finally:
+        if built and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"farm": farm["counts"], "benchmarks": benchmarks, "memory": memory}, indent=2))
+    else:
+        print(format_report(farm, benchmarks, memory))
+
+
+##############################################################################
+
+
+#### Startup ####
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stale repository checker against a synthetic repository farm.")
+    parser.add_argument("--farm", help="Directory to build the farm in, or an existing farm to reuse. Defaults to a temporary directory.")
+    parser.add_argument("--keep", help="Keep the farm after benchmarking (only with --farm)", action="store_true")
+    parser.add_argument("--seed", help="Random seed deciding which repositories are dirty/out of sync", type=int, default=0)
+    parser.add_argument("-r", "--repos", help="Number of repositories", type=int, default=100)
+    parser.add_argument("-d", "--depth", help="Depth the repositories are placed at (and scanned to)", type=int, default=2)
+    parser.add_argument("--commits", help="Commits in every repository's history", type=int, default=20)
+    parser.add_argument("--files", help="Tracked files in every repository", type=int, default=50)
+    parser.add_argument("--untracked", help="Untracked files added to the repositories that get them", type=int, default=0)
+    parser.add_argument("--untracked-ratio", help="Fraction of repositories with untracked files", type=float, default=0.5)
+    parser.add_argument("--dirty", help="Fraction of repositories with a modified file", type=float, default=0.2)
+    parser.add_argument("--ahead", help="Fraction of repositories ahead of their remote", type=float, default=0.1)
+    parser.add_argument("--behind", help="Fraction of repositories behind their remote", type=float, default=0.1)
+    parser.add_argument("--diverged", help="Fraction of repositories diverged from their remote", type=float, default=0.1)
+    parser.add_argument("--bare-remotes", help="Give every repository its own local bare remote instead of sharing one", action="store_true")
+    parser.add_argument("--repeat", help="Times each benchmark is run", type=int, default=3)
+    parser.add_argument("--startup-repeat", help="Times each startup benchmark is run, they're short so they need more runs", type=int, default=20)
+    parser.add_argument("--startup-only", help="Only benchmark the startup time, without building a farm", action="store_true")
+    parser.add_argument("-j", "--jobs", help="Concurrent checks", type=int, default=checker.get_default_jobs())
+    parser.add_argument("-b", "--backend", help="Backend to benchmark. Can be repeated, defaults to all of them.", action="append", choices=checker.BACKENDS.keys(), dest="backends")
+    parser.add_argument("-l", "--list", help="Check with file listing, like -l", action="store_true", dest="list_files")
+    parser.add_argument("-a", "--all-branches", help="Audit every branch, like -a", action="store_true")
+    parser.add_argument("--json", help="Print the results as JSON", action="store_true")
+    args = parser.parse_args()
+
+    args.backends = args.backends or list(checker.BACKENDS)
+    args.depth = max(args.depth, 1)
+    args.repeat = max(args.repeat, 1)
+    args.startup_repeat = max(args.startup_repeat, 1)
+    if args.keep and not args.farm:
+        parser.error("--keep needs --farm")
+
+    main(args)
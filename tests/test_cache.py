@@ -0,0 +1,83 @@
+# Checks for the scan cache. Run from the repository root with:
+#   python -m unittest discover tests
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@unittest.skipUnless(shutil.which("git"), "git isn't installed")
+class ScanCacheTest(unittest.TestCase):
+    """Results reused from the ScanCache against fresh checks."""
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        self.root = os.path.join(self.temp.name, "scan")
+        self.directory = os.path.join(self.root, "clean")
+        self.env = dict(os.environ, GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@a", GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@a")
+
+        # A clone that is in sync with its remote, so it's clean and its result gets cached
+        remote = os.path.join(self.temp.name, "remote.git")
+        self.git(self.temp.name, "init", "-q", "--bare", "-b", "main", remote)
+        self.git(self.temp.name, "clone", "-q", remote, self.directory)
+        with open(os.path.join(self.directory, "tracked"), "w") as f:
+            f.write("tracked")
+        # Older than the index, otherwise it's racily clean and the first `git status` rewrites the index (and the fingerprint with it)
+        os.utime(os.path.join(self.directory, "tracked"), (1_000_000_000, 1_000_000_000))
+        self.git(self.directory, "add", "tracked")
+        self.git(self.directory, "commit", "-q", "-m", "initial")
+        self.git(self.directory, "push", "-q", "origin", "main")
+
+        self.cache_path = os.path.join(self.temp.name, "cache.jsonl")
+
+    def git(self, cwd: str, *args: str):
+        subprocess.run(["git", *args], cwd=cwd, capture_output=True, check=True, env=self.env)
+
+    def scan(self, options: main.CheckOptions) -> tuple[main.StaleResult, main.ScanStats]:
+        cache = main.ScanCache(self.cache_path).load()
+        stats = main.ScanStats()
+        results = main.scan_directories([self.directory], 1, False, "porcelain", stats, cache, options)
+        cache.save(self.root)
+        self.assertEqual(len(results), 1)
+        return results[0], stats
+
+    def test_reused_result_lists_new_untracked_files(self):
+        options = main.CheckOptions(list_files=True, untracked="normal")
+        result, stats = self.scan(options)
+        self.assertFalse(result.stale)
+        self.assertEqual(stats.cached, 0)
+
+        # A new untracked file changes neither .git nor any tracked file, the cached result is still reused
+        with open(os.path.join(self.directory, "new file"), "w") as f:
+            f.write("new")
+        result, stats = self.scan(options)
+        self.assertEqual(stats.cached, 1)
+        self.assertFalse(result.stale)
+        self.assertEqual(list(result.files.untracked), ["new file"])
+        self.assertEqual(result.files.untracked_count, 1)
+
+        os.remove(os.path.join(self.directory, "new file"))
+        result, stats = self.scan(options)
+        self.assertEqual(stats.cached, 1)
+        self.assertEqual((list(result.files.untracked), result.files.untracked_count), ([], 0))
+
+    def test_modified_file_isnt_reused(self):
+        options = main.CheckOptions(list_files=True)
+        self.scan(options)
+        with open(os.path.join(self.directory, "tracked"), "a") as f:
+            f.write(" changed")
+        result, stats = self.scan(options)
+        self.assertEqual(stats.cached, 0)
+        self.assertTrue(result.stale)
+        self.assertEqual(list(result.files.modified), ["tracked"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,220 @@
+# Checks for the hand-written parsers of git's formats. Run from the repository root with:
+#   python -m unittest discover tests
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+OID_A = "a" * 40
+OID_B = "b" * 40
+OID_C = "c" * 40
+
+
+class PorcelainStatusTest(unittest.TestCase):
+    """parse_porcelain_status against `git status --porcelain=v2 --branch -z` output."""
+
+    def parse(self, *entries: str, options: main.CheckOptions = main.CheckOptions()) -> main.PorcelainStatus:
+        return main.parse_porcelain_status("\0".join(entries) + "\0", options)
+
+    def test_branch_headers(self):
+        status = self.parse(f"# branch.oid {OID_A}", "# branch.head master", "# branch.upstream origin/master", "# branch.ab +1 -2")
+        self.assertEqual((status.branch, status.upstream, status.ahead, status.behind), ("master", "origin/master", 1, 2))
+        self.assertEqual(status.state, main.REPO_STATE_OK)
+        self.assertFalse(status.changed)
+
+    def test_branch_states(self):
+        self.assertEqual(self.parse(f"# branch.oid {OID_A}", "# branch.head (detached)").state, main.REPO_STATE_DETACHED)
+        self.assertEqual(self.parse(f"# branch.oid {OID_A}", "# branch.head (detached)").branch, OID_A[:7])
+        self.assertEqual(self.parse("# branch.oid (initial)", "# branch.head master").state, main.REPO_STATE_UNBORN)
+        self.assertEqual(self.parse(f"# branch.oid {OID_A}", "# branch.head master").state, main.REPO_STATE_NO_UPSTREAM)
+        # No branch.ab: the upstream is configured but doesn't exist
+        self.assertEqual(self.parse(f"# branch.oid {OID_A}", "# branch.head master", "# branch.upstream origin/gone").state, main.REPO_STATE_UPSTREAM_GONE)
+
+    def test_ordinary_entries(self):
+        status = self.parse(
+            f"1 .M N... 100644 100644 100644 {OID_A} {OID_A} name with spaces.txt",
+            f"1 M. N... 100644 100644 100644 {OID_A} {OID_B} staged only",
+        )
+        self.assertTrue(status.changed)
+        # Only worktree changes are listed, like index.diff(None)
+        self.assertEqual(list(status.files.modified), ["name with spaces.txt"])
+
+    def test_renamed_entries(self):
+        # The original path follows a rename as its own entry, it mustn't be taken for another entry
+        status = self.parse(
+            f"2 R. N... 100644 100644 100644 {OID_A} {OID_A} R100 new name",
+            "1 old name",
+            f"2 RM N... 100644 100644 100644 {OID_A} {OID_A} R087 edited",
+            "original",
+            "? untracked",
+        )
+        self.assertTrue(status.changed)
+        self.assertEqual(list(status.files.modified), ["edited"])
+        self.assertEqual(list(status.files.untracked), ["untracked"])
+
+    def test_unmerged_entries(self):
+        status = self.parse(f"u UU N... 100644 100644 100644 100644 {OID_A} {OID_B} {OID_C} both modified.c")
+        self.assertTrue(status.changed)
+        self.assertEqual(list(status.files.modified), ["both modified.c"])
+
+    def test_caps_and_counts(self):
+        status = self.parse("? a", "? b", "? c", options=main.CheckOptions(max_files=2))
+        self.assertEqual(list(status.files.untracked), ["a", "b"])
+        self.assertEqual(status.files.untracked_count, 3)
+
+
+class GitConfigTest(unittest.TestCase):
+    """read_git_config against `git config --list`."""
+
+    CONFIG = "\n".join([
+        "# comment",
+        "[Core]",
+        "\tBare = false",
+        "\tquiet",
+        '[remote "origin"]',
+        "\turl = git@example.com:repo.git ; trailing comment",
+        '\tfetch = "+refs/heads/*:refs/remotes/origin/*"',
+        '[branch "feature/x"]',
+        "\tremote = origin",
+        '[branch "a\\""]',
+        "\tremote = upstream",
+        '[remote "my \\"odd\\" \\\\ remote"]',
+        '\turl = "/path # with hash"',
+        "[section.Sub]",
+        "\tkey = value",
+    ]) + "\n"
+
+    def test_against_git(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "config")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.CONFIG)
+            config = main.read_git_config(path)
+
+            if shutil.which("git"):
+                listed = subprocess.run(["git", "config", "--file", path, "--list", "-z"], capture_output=True, check=True).stdout.decode()
+                expected = dict(item.split("\n", 1) if "\n" in item else (item, "true") for item in listed.split("\0") if item)
+                self.assertEqual(config, expected)
+
+        self.assertEqual(config["core.quiet"], "true")
+        self.assertEqual(config["remote.origin.url"], "git@example.com:repo.git")
+        self.assertEqual(config["branch.feature/x.remote"], "origin")
+        self.assertEqual(config['branch.a".remote'], "upstream")
+        self.assertEqual(config['remote.my "odd" \\ remote.url'], "/path # with hash")
+
+    def test_upstream_ref(self):
+        config = {"branch.main.remote": "origin", "branch.main.merge": "refs/heads/main", "remote.origin.fetch": "+refs/heads/*:refs/remotes/origin/*"}
+        self.assertEqual(main.get_upstream_ref(config, "main"), "refs/remotes/origin/main")
+        self.assertEqual(main.get_upstream_ref({"branch.x.remote": ".", "branch.x.merge": "refs/heads/main"}, "x"), "refs/heads/main")
+        self.assertIsNone(main.get_upstream_ref({}, "main"))
+
+
+@unittest.skipUnless(shutil.which("git"), "git isn't installed")
+class GitRepositoryFormatsTest(unittest.TestCase):
+    """read_git_index and the object readers against repositories written by git itself."""
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+        self.directory = self.temp.name
+        self.env = dict(os.environ, GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@a", GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@a")
+        self.git("init", "-q")
+        # Shared prefixes and nesting are what index v4 compresses
+        for name in ["a.txt", "dir/file", "dir/file2", "dir/sub/deep name", "dir2/file", "z"]:
+            path = os.path.join(self.directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(name * 3)
+        os.chmod(os.path.join(self.directory, "z"), 0o755)
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+
+    def git(self, *args: str) -> str:
+        return subprocess.run(["git", "-C", self.directory, *args], capture_output=True, check=True, env=self.env).stdout.decode()
+
+    def check_index(self, version: int):
+        self.git("update-index", "--index-version", str(version))
+        index = main.read_git_index(os.path.join(self.directory, ".git", "index"))
+        self.assertIsNotNone(index)
+
+        staged = [line.split(None, 3) for line in self.git("ls-files", "-s").splitlines()]
+        self.assertEqual([(entry.path, entry.mode) for entry in index.entries], [(path, int(mode, 8)) for mode, _, _, path in staged])
+        for entry in index.entries:
+            st = os.stat(os.path.join(self.directory, entry.path))
+            self.assertEqual((entry.size, entry.mtime_s, entry.mtime_ns), (st.st_size, int(st.st_mtime), st.st_mtime_ns % 1_000_000_000))
+        self.assertEqual(index.tree, self.git("rev-parse", "HEAD^{tree}").strip())
+
+    def test_index_v2(self):
+        self.check_index(2)
+
+    def test_index_v4(self):
+        self.check_index(4)
+
+    def test_index_intent_to_add(self):
+        # Intent-to-add needs the extended flags (v3), such indexes are left to git
+        with open(os.path.join(self.directory, "new"), "w") as f:
+            f.write("new")
+        self.git("add", "-N", "new")
+        self.assertIsNone(main.read_git_index(os.path.join(self.directory, ".git", "index")))
+
+    def test_objects(self):
+        git_dir = os.path.join(self.directory, ".git")
+        commit = self.git("rev-parse", "HEAD").strip()
+        expected = ("commit", subprocess.run(["git", "-C", self.directory, "cat-file", "commit", commit], capture_output=True, check=True).stdout)
+        self.assertEqual(main.read_loose_object(git_dir, commit), expected)
+        self.assertIsNone(main.read_packed_object(git_dir, commit))
+
+        self.git("gc", "-q")
+        self.assertIsNone(main.read_loose_object(git_dir, commit))
+        self.assertEqual(main.read_packed_object(git_dir, commit), expected)
+        self.assertEqual(main.read_commit_tree(git_dir, commit), self.git("rev-parse", "HEAD^{tree}").strip())
+
+
+class BranchAuditTest(unittest.TestCase):
+    """parse_branch_audit against `git for-each-ref` output."""
+
+    def test_fixture(self):
+        output = "\n".join([
+            "refs/heads/main\0origin/main\0",
+            "refs/heads/ahead\0origin/ahead\0ahead 1",
+            "refs/heads/both\0origin/both\0ahead 2, behind 3",
+            "refs/heads/feature/x\0origin/feature/x\0behind 4",
+            "refs/heads/gone\0origin/gone\0gone",
+            "refs/heads/local\0\0",
+        ]) + "\n"
+        self.assertEqual(main.parse_branch_audit(output), [
+            main.BranchStatus("ahead", "origin/ahead", 1, 0),
+            main.BranchStatus("both", "origin/both", 2, 3),
+            main.BranchStatus("feature/x", "origin/feature/x", 0, 4),
+            main.BranchStatus("gone", "origin/gone", state=main.REPO_STATE_UPSTREAM_GONE),
+            main.BranchStatus("local", state=main.REPO_STATE_NO_UPSTREAM),
+        ])
+
+    @unittest.skipUnless(shutil.which("git"), "git isn't installed")
+    def test_against_git(self):
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@a", GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@a")
+            def git(*args: str):
+                subprocess.run(["git", "-C", directory, *args], capture_output=True, check=True, env=env)
+            git("init", "-q", "-b", "main")
+            git("commit", "-q", "--allow-empty", "-m", "one")
+            git("branch", "in-sync")
+            git("branch", "--set-upstream-to", "main", "in-sync")
+            git("branch", "ahead")
+            git("branch", "--set-upstream-to", "main", "ahead")
+            git("checkout", "-q", "ahead")
+            git("commit", "-q", "--allow-empty", "-m", "two")
+            self.assertEqual(main.audit_branches(directory), [
+                main.BranchStatus("ahead", "main", 1, 0),
+                main.BranchStatus("main", state=main.REPO_STATE_NO_UPSTREAM),
+            ])
+
+if __name__ == "__main__":
+    unittest.main()